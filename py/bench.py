@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmarks for simcpu and crashbots. Results are written as JSON with
+stable keys and can be compared against a saved baseline.
+
+Usage: bench.py [options], see --help
+'''
+
+import sys
+import json
+import argparse
+import platform
+import timeit
+import simcpu
+import crashbots
+
+## Instructions in the loop of each opcode benchmark
+UNROLL = 50
+## Seconds each measurement should at least take
+MIN_TIME = 0.05
+## Measurements per benchmark, the best one is kept
+REPEAT = 5
+## Seconds spent running a match before measuring, the first
+## measurements are slow otherwise
+WARMUP = 1.0
+## Slowdown against the baseline reported as a regression
+THRESHOLD = 0.1
+
+## Lines repeated UNROLL times per opcode, %d is the repetition. Some
+## opcodes are measured in pairs so the stack and trace flag stay balanced.
+OPCODE_LINES = {
+    'copy': ['copy R0 1'],
+    'compute': ['compute R0 + R0 1'],
+    'test': ['test R0 < 5'],
+    'jump': ['jump next%d', 'next%d:'],
+    'jumpif': ['jumpif far'],
+    'callif': ['callif far'],
+    'call+back': ['call sub'],
+    'push+pop': ['push R0', 'pop R1'],
+    'trace+traceoff': ['trace', 'traceoff'],
+    'debug': ['debug R0'],
+    'longdebug': ['longdebug'],
+}
+
+## Scanning robot from the README, used for the robot and arena benchmarks
+SCANNER_BOT = '''
+    copy @_desired_speed 3
+main:
+    copy R2 48
+    copy R3 _scanner
+look:
+    test @R3 = 'W'
+    callif avoid_wall
+    compute R3 + R3 1
+    compute R2 - R2 1
+    test R2 >= 0
+    jumpif look
+    jump main
+avoid_wall:
+    compute @_desired_heading + @_heading 90
+    back
+'''.split('\n')
+
+## Robot circling and ramming what it meets
+SPINNER_BOT = '''
+    copy @_desired_speed 10
+loop:
+    compute @_desired_heading + @_heading 90
+    compute R0 + R0 1
+    test R0 < 1000
+    jumpif loop
+    copy R0 0
+    jump loop
+'''.split('\n')
+
+## Robot turning away from walls found with a system call
+SYSCALL_BOT = '''
+    copy @_desired_speed 3
+main:
+    call _nearest_wall
+    jumpif avoid_wall
+    jump main
+avoid_wall:
+    compute @_desired_heading + @_heading 90
+    jump main
+'''.split('\n')
+
+def measure(func, number=None):
+    '''
+    Best seconds per call of func over REPEAT measurements. Without number
+    the calls per measurement are picked so each takes at least MIN_TIME.
+    '''
+    if number is None:
+        number = 1
+        while timeit.timeit(func, number=number) < MIN_TIME:
+            number *= 2
+    return min(timeit.repeat(func, number=number, repeat=REPEAT)) / number
+
+def opcode_program(name):
+    '''An endless loop running the instructions for name UNROLL times.'''
+    lines = ['copy R0 0', 'start:']
+    for index in xrange(UNROLL):
+        lines.extend([line.replace('%d', str(index)) for line in OPCODE_LINES[name]])
+    lines.extend(['jump start', 'sub:', 'back', 'far:', 'halt'])
+    return lines
+
+def large_program(blocks=40):
+    '''A program of blocks small loops, about five lines per block.'''
+    lines = ['copy R0 0']
+    for index in xrange(blocks):
+        lines.extend(['loop%d:' % index, 'compute R0 + R0 1', 'test R0 < %d' % (index * 5), 'jumpif loop%d' % index,
+                      'copy @data R0'])
+    lines.extend(['halt', 'data:', '=0'])
+    return lines
+
+def bench_opcodes(results, engines=simcpu.ENGINES):
+    '''Microseconds per instruction for every opcode and engine.'''
+    for name in sorted(OPCODE_LINES):
+        for engine in engines:
+            cpu = simcpu.Cpu(name, engine=engine)
+            cpu.out = simcpu.NoOutput()
+            cpu.load(opcode_program(name))
+            cycles = UNROLL * len([line for line in OPCODE_LINES[name] if ':' not in line]) + 1
+            results['opcode.%s.%s' % (name, engine)] = measure(lambda: cpu.run_cycles(cycles)) / cycles * 1e6
+
+def bench_load(results):
+    '''Microseconds to load small and large programs, parsing them or from
+    the image cache, and to verify them.'''
+    small = crashbots.Robot.base_program + SCANNER_BOT
+    for size, lines in [('small', small), ('large', large_program())]:
+        def parse():
+            simcpu.Cpu.images.clear()
+            simcpu.Cpu(size).load(lines)
+        results['load.%s.parse' % size] = measure(parse) * 1e6
+        results['load.%s.cached' % size] = measure(lambda: simcpu.Cpu(size).load(lines)) * 1e6
+        cpu = simcpu.Cpu(size)
+        cpu.load(lines)
+        results['load.%s.validate' % size] = measure(cpu.program_validate) * 1e6
+
+def bench_robot(results):
+    '''Microseconds per tick for a single robot and for its post_move, with
+    the scanner walked in the program or by a system call.'''
+    for name, program in [('tick', SCANNER_BOT), ('syscall_tick', SYSCALL_BOT)]:
+        arena = crashbots.Arena(20, 20, headless=True)
+        robot = arena.add_robot('scanner', 10, 10, program)
+        def tick():
+            arena.think([robot])
+            arena.move(robot)
+            robot.scan_dirty = True
+            arena.post_move()
+        results['robot.' + name] = measure(tick) * 1e6
+    def post_move():
+        robot.scan_dirty = True
+        robot.post_move()
+    results['robot.post_move'] = measure(post_move) * 1e6
+
+def bench_arena(results, sizes=(2, 8, 64), ticks=50):
+    '''Microseconds per tick of arena matches with sizes robots.'''
+    for size in sizes:
+        def match():
+            arena = crashbots.Arena(30, 30, headless=True)
+            for index, (x, y) in enumerate(arena.free_squares(size, 1)):
+                arena.add_robot('bot%d' % index, x, y, [SCANNER_BOT, SPINNER_BOT][index % 2])
+            for _ in xrange(ticks):
+                arena.run_tick()
+        results['arena.%d' % size] = measure(match, 1) / ticks * 1e6
+
+## Benchmark groups by name
+GROUPS = {
+    'opcode': bench_opcodes,
+    'load': bench_load,
+    'robot': bench_robot,
+    'arena': bench_arena,
+}
+
+def run(groups=sorted(GROUPS)):
+    '''Runs the benchmark groups, returns the results as saved in JSON.'''
+    start = timeit.default_timer()
+    while timeit.default_timer() - start < WARMUP:
+        bench_arena({}, (8,), 10)
+    results = {}
+    for group in groups:
+        GROUPS[group](results)
+    return {'unit': 'us', 'python': platform.python_version(),
+            'results': dict([(name, round(value, 3)) for name, value in results.iteritems()])}
+
+def compare(baseline, current, threshold=THRESHOLD):
+    '''
+    Lines comparing the results in current with baseline, and the names of
+    the results that are slower by more than threshold. Results missing
+    from current are left out so groups can be compared on their own.
+
+    >>> lines, slower = compare({'results': {'a': 2.0, 'b': 1.0, 'c': 3.0}}, {'results': {'a': 1.0, 'b': 1.5, 'd': 1.0}})
+    >>> print '\\n'.join(lines)
+    benchmark  baseline   current  change
+    a             2.000     1.000  -50.0%
+    b             1.000     1.500  +50.0% slower
+    d                 -     1.000
+    >>> slower
+    ['b']
+    '''
+    old, new = baseline['results'], current['results']
+    names = sorted(new)
+    width = max([len('benchmark')] + [len(name) for name in names])
+    lines = ['%-*s  baseline   current  change' % (width, 'benchmark')]
+    slower = []
+    for name in names:
+        if name not in old:
+            lines.append('%-*s %9s %9.3f' % (width, name, '-', new[name]))
+            continue
+        change = new[name] / old[name] - 1 if old[name] else 0.0
+        line = '%-*s %9.3f %9.3f %+6.1f%%' % (width, name, old[name], new[name], change * 100)
+        if change > threshold:
+            slower.append(name)
+            line += ' slower'
+        lines.append(line)
+    return lines, slower
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks simcpu and crashbots.')
+    parser.add_argument('groups', nargs='*', help='groups to run: %s (default: all)' % ', '.join(sorted(GROUPS)))
+    parser.add_argument('--output', help='write the results as JSON to this file (default: stdout)')
+    parser.add_argument('--baseline', help='compare with the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='slowdown reported as a regression (default: %(default)s)')
+    args = parser.parse_args(argv)
+    for group in args.groups:
+        if group not in GROUPS:
+            parser.error('unknown group ' + group)
+    current = run(args.groups or sorted(GROUPS))
+    data = json.dumps(current, indent=1, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    elif not args.baseline:
+        sys.stdout.write(data)
+    if args.baseline:
+        with open(args.baseline) as f:
+            lines, slower = compare(json.load(f), current, args.threshold)
+        print '\n'.join(lines)
+        if slower:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
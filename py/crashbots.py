@@ -1,17 +1,63 @@
 # -*- coding: utf-8 -*-
 
+import sys
+import random
+import operator
 import simcpu
 from itertools import chain
 
 TOP_SPEED = 10
 SCANNER_RANGE = 3
 SCANNER_GRID = (SCANNER_RANGE*2+1) ** 2
+## CPU cycles each robot gets per tick
+CYCLES_PER_TICK = 30
+## Wall marker in the scanner
+WALL = 'W'
+## Robot attributes kept by Arena.checkpoint, besides the Cpu state
+CHECKPOINT_FIELDS = ('pos_x', 'pos_y', 'speed', 'heading', 'health', 'desired_speed', 'desired_heading', 'scan_dirty')
+## CPU cycles charged for a system call, the call instruction included,
+## see Robot.syscalls
+SYSCALL_CYCLES = 5
+## Scanner grid index, dx and dy of every square but the center, nearest
+## (by squares to move) first
+SCANNER_OFFSETS = [(index, dx, dy) for _, index, dx, dy in sorted(
+    [(abs(dx) + abs(dy), (dy + SCANNER_RANGE) * (SCANNER_RANGE * 2 + 1) + dx + SCANNER_RANGE, dx, dy)
+     for dy in xrange(-SCANNER_RANGE, SCANNER_RANGE + 1) for dx in xrange(-SCANNER_RANGE, SCANNER_RANGE + 1)
+     if dx or dy])]
+## Picks the squares of a scanner grid in SCANNER_OFFSETS order
+SCANNER_ORDER = operator.itemgetter(*[index for index, _, _ in SCANNER_OFFSETS])
+
+def control_value(value):
+    '''A desired speed or heading read from robot memory, 0 unless it is a
+    finite number.'''
+    if type(value) in (int, long, float) and value == value and abs(value) != float('inf'):
+        return value
+    return 0
+
+def nearest_wall(grid):
+    '''dx and dy of the nearest wall in a scanner grid, None if there is none.'''
+    try:
+        return SCANNER_OFFSETS[SCANNER_ORDER(grid).index(WALL)][1:]
+    except ValueError:
+        return None
+
+def nearest_robot(grid):
+    '''Id, dx and dy of the nearest other robot in a scanner grid, None if
+    there is none.'''
+    for index, value in enumerate(SCANNER_ORDER(grid)):
+        if value and value != WALL:
+            return (value,) + SCANNER_OFFSETS[index][1:]
+    return None
 
 class Properties(object):
     def __init__(self, **kwargs):
+        self.__keys = sorted(kwargs.keys())
         for key, val in kwargs.iteritems():
             setattr(self, key, val)
 
+    def __repr__(self):
+        return 'Properties(' + ', '.join(['%s=%r' % (key, getattr(self, key)) for key in self.__keys]) + ')'
+
 class Robot(object):
     '''
     Cpu controlled robot.
@@ -36,19 +82,31 @@ class Robot(object):
     =0
     _scanner:
     """ + '\n'.join(['=0' for _ in range(SCANNER_GRID)]) + """
+    _position:
+    halt
+    _nearest_wall:
+    halt
+    _nearest_robot:
+    halt
     _pgmstart:
     """).split('\n')
 
-    def __init__(self, name, pos_x, pos_y, scanner, program):
+    def __init__(self, name, pos_x, pos_y, scanner, program, engine=simcpu.REFERENCE, lookup=None,
+                 memsize=simcpu.MEMSIZE, registers=simcpu.REGISTERS, sparse=False):
         '''
         Creates a robot.
         name -- Any string, not too long though
         pos_x -- Initial horizontal position
         pos_y -- Initial vertical position
-        scanner -- callback method that returns a grid around a point, takes two args: x, y
-        program -- Line iterator for robot control program
+        scanner -- callback method that writes the grid around a point into memory, takes
+                   four args: x, y, memory, start. See Arena.scan
+        program -- Line iterator for robot control program, a list, a file or a generator
+        engine -- simcpu engine running the program
+        lookup -- callback returning the Robot with the id it is given, for _position
+        memsize, registers, sparse -- Memory words, registers and sparse memory of the Cpu, see simcpu.Cpu
         '''
         self.name = name
+        self.id = 0
         self.health = 100
         self.pos_x = pos_x * 10
         self.pos_y = pos_y * 10
@@ -57,47 +115,178 @@ class Robot(object):
         self.desired_speed = 0
         self.desired_heading = 0
         self.scanner = scanner
-        self.cpu = simcpu.Cpu(name)
-        self.cpu.load(chain(Robot.base_program, program))
+        self.lookup = lookup
+        # Set when the scanner grid needs to be written again
+        self.scan_dirty = True
+        self.out = sys.stdout
+        self.cpu = simcpu.Cpu(name, engine, memsize, registers, sparse)
+        # The fast engine runs common sequences, like scanner loops, fused
+        fuse = engine == simcpu.FAST
+        if isinstance(program, (list, tuple)):
+            # Whole programs are hashed first so cached images skip parsing
+            self.cpu.load(Robot.base_program + list(program), fuse=fuse)
+        else:
+            self.cpu.load(chain(Robot.base_program, program), fuse=fuse)
+        labels = self.cpu.labels
+        self.speed_addr = labels['_speed']
+        self.heading_addr = labels['_heading']
+        self.health_addr = labels['_health']
+        self.pos_x_addr = labels['_pos_x']
+        self.pos_y_addr = labels['_pos_y']
+        self.desired_speed_addr = labels['_desired_speed']
+        self.desired_heading_addr = labels['_desired_heading']
+        self.scanner_addr = labels['_scanner']
+        # Scanner grid and what was found in it by search, see nearest
+        self.found = {}
+        for addr in (self.speed_addr, self.heading_addr, self.health_addr, self.pos_x_addr, self.pos_y_addr):
+            self.cpu.protect(addr)
+        self.cpu.protect(self.scanner_addr, SCANNER_GRID)
+        for label, handler in self.syscalls().iteritems():
+            # The call instruction counts one cycle of its own
+            self.cpu.syscall(label, handler, SYSCALL_CYCLES - 1)
+
+    def syscalls(self):
+        '''
+        System call handlers by label. Each is called with the robot Cpu and
+        costs SYSCALL_CYCLES cycles, the call included. They look at the
+        scanner grid, set the test flag if they find what they look for and
+        put the result in the registers, which are left alone otherwise.
+
+        _position -- Speed and heading of the robot with id R0 in R0 and R1
+        _nearest_wall -- dx and dy of the nearest wall square in R0 and R1
+        _nearest_robot -- Id, dx and dy of the nearest other robot in R0, R1 and R2
+
+        >>> arena = Arena(5, 1, headless=True)
+        >>> seeker = arena.add_robot('seeker', 0, 0, [
+        ...     'call _nearest_robot', 'copy @_desired_heading 90', 'copy R3 R0', 'call _position',
+        ...     'call _nearest_wall', 'halt'])
+        >>> runner = arena.add_robot('runner', 2, 0, ['copy @_desired_speed 4', 'copy @_desired_heading 180', 'halt'])
+        >>> seeker.post_move()
+        >>> arena.run_tick()
+        >>> seeker.cpu.registers, seeker.cpu.test_flag
+        ([0, -1, 0, 2], True)
+        >>> seeker.cpu.run_cycles(100)
+        0
+        >>> seeker.cpu.program_counter == seeker.cpu.labels['_pgmstart'] + 5
+        True
+
+        The jump to _pgmstart, the call and the halt take:
+
+        >>> caller = arena.add_robot('caller', 4, 0, ['call _nearest_wall', 'halt'])
+        >>> caller.cpu.run_cycles(1 + SYSCALL_CYCLES + 1), caller.cpu.halted_flag
+        (7, True)
+        '''
+        return {'_position': self.sys_position, '_nearest_wall': self.sys_nearest_wall,
+                '_nearest_robot': self.sys_nearest_robot}
+
+    def sys_position(self, cpu):
+        ident = cpu.registers[0]
+        cpu.test_flag = False
+        if ident == WALL or not ident or ident not in self.scanned(cpu) or self.lookup is None:
+            return
+        robot = self.lookup(int(ident))
+        if robot is not None:
+            cpu.registers[0], cpu.registers[1] = robot.speed, robot.heading
+            cpu.test_flag = True
+
+    def sys_nearest_wall(self, cpu):
+        found = self.nearest(cpu, nearest_wall)
+        cpu.test_flag = found is not None
+        if found is not None:
+            cpu.registers[0], cpu.registers[1] = found
+
+    def sys_nearest_robot(self, cpu):
+        found = self.nearest(cpu, nearest_robot)
+        cpu.test_flag = found is not None
+        if found is not None:
+            cpu.registers[0], cpu.registers[1], cpu.registers[2] = found
+
+    def scanned(self, cpu):
+        '''The scanner grid as the program sees it.'''
+        return cpu.memory[self.scanner_addr:self.scanner_addr + SCANNER_GRID]
+
+    def nearest(self, cpu, find):
+        '''find applied to the scanner grid, kept until the grid changes.
+        Rescanning writes the same objects for the same squares, so telling
+        whether the grid changed is cheaper than searching it.'''
+        grid = self.scanned(cpu)
+        last = self.found.get(find)
+        if last is None or last[0] != grid:
+            last = self.found[find] = (grid, find(grid))
+        return last[1]
 
     def cpu_cycles(self, cycles):
-        for a in xrange(cycles):
-            self.cpu.cpu_cycle()
+        '''Runs the robot program for up to cycles CPU cycles, returns the cycles used.'''
+        return self.cpu.run_cycles(cycles)
 
     def pre_move(self):
-        self.desired_speed = self.cpu.get_value('@_desired_speed')
-        self.desired_heading = self.cpu.get_value('@_desired_heading')
-        
+        '''
+        Reads the desired speed and heading the program set, anything but a
+        finite number counts as 0.
+
+        >>> arena = Arena(5, 1, headless=True)
+        >>> robot = arena.add_robot('confused', 0, 0, [
+        ...     "copy @_desired_speed 'fast'", "copy @_desired_heading 'x'", 'halt'])
+        >>> arena.run_tick()
+        >>> robot.desired_speed, robot.desired_heading, robot.speed, robot.heading
+        (0, 0, 0, 0)
+        '''
+        self.desired_speed = control_value(self.cpu.read(self.desired_speed_addr))
+        self.desired_heading = control_value(self.cpu.read(self.desired_heading_addr))
+
     def move(self):
         self.speed = max(0, min(TOP_SPEED, int(self.desired_speed)))
         self.heading = ((self.desired_heading % 360) // 90) * 90
         if self.heading == 0:
-            print "HEADING 0:", self.pos_y, self.speed
+            self.out.write("HEADING 0: %s %s\n" % (self.pos_y, self.speed))
             self.pos_y -= self.speed
         elif self.heading == 180:
-            print "HEADING 180:", self.pos_y, self.speed
+            self.out.write("HEADING 180: %s %s\n" % (self.pos_y, self.speed))
             self.pos_y += self.speed
         elif self.heading == 90:
-            print "HEADING 90:", self.pos_x, self.speed
+            self.out.write("HEADING 90: %s %s\n" % (self.pos_x, self.speed))
             self.pos_x += self.speed
         elif self.heading == 270:
-            print "HEADING 270:", self.pos_x, self.speed
+            self.out.write("HEADING 270: %s %s\n" % (self.pos_x, self.speed))
             self.pos_x -= self.speed
         else:
-            raise RuntimeException("Unsupported heading: " + str(self.heading))
+            raise simcpu.RuntimeException("Unsupported heading: " + str(self.heading))
 
     def post_move(self):
-        def set_ro(label, val):
-            addr = self.cpu.get_address(label)
-            self.cpu.memory[addr] = simcpu.Getable(val)
-        set_ro('_speed', self.speed)
-        set_ro('_heading', self.heading)
-        set_ro('_health', self.health)
-        set_ro('_pos_x', self.pos_x // 10)
-        set_ro('_pos_y', self.pos_y // 10)
-        scanbase = self.cpu.get_address('_scanner')
-        for idx, val in enumerate(self.scanner(self.pos_x // 10, self.pos_y // 10)):
-            self.cpu.memory[scanbase + idx] = val
+        '''Updates the read only robot state in CPU memory, and the scanner
+        if scan_dirty is set.'''
+        memory = self.cpu.memory
+        memory[self.speed_addr] = self.speed
+        memory[self.heading_addr] = self.heading
+        memory[self.health_addr] = self.health
+        memory[self.pos_x_addr] = self.pos_x // 10
+        memory[self.pos_y_addr] = self.pos_y // 10
+        if self.scan_dirty:
+            self.scan_dirty = False
+            self.scanner(self.pos_x // 10, self.pos_y // 10, memory, self.scanner_addr)
+
+    def physical_state(self):
+        '''Position, movement and health, with cpu_state everything that
+        decides how the robot plays on. See Arena.run.'''
+        return (self.pos_x, self.pos_y, self.speed, self.heading, self.health,
+                self.desired_speed, self.desired_heading, self.scan_dirty)
+
+    def cpu_state(self):
+        '''The program state, None once halted as it never runs again.
+        Values are paired with their types as 1 and 1.0 compute differently.
+        Of sparse memory only the cells set over the shared program image
+        are compared.'''
+        cpu = self.cpu
+        if cpu.halted_flag:
+            return None
+        memory = cpu.memory
+        addrs = None
+        if isinstance(memory, simcpu.SparseList):
+            addrs = tuple(sorted(memory.iterkeys()))
+            memory = [memory[addr] for addr in addrs]
+        values = tuple(memory) + tuple(cpu.registers) + tuple(cpu.stack)
+        return (cpu.program_counter, cpu.test_flag, cpu.trace_flag, cpu.stall, len(cpu.stack),
+                addrs, values, tuple(map(type, values)))
 
     def __str__(self):
         return repr(self)
@@ -105,26 +294,360 @@ class Robot(object):
     def __repr__(self):
         return '<Robot(%r, %r, %r, <scanner>, <program>) health=%r, speed=%r, heading=%r, desired_speed=%r, desired_heading=%r>' % (self.name, self.pos_x // 10, self.pos_y // 10, self.health, self.speed, self.heading, self.desired_speed, self.desired_heading)
 
-def empty_scanner(x,y):
-    return [0 for r in range(SCANNER_GRID)]
+class Arena(object):
+    '''
+    A rectangular arena surrounded by walls, owns the robots and runs the
+    game one tick at a time: CPU cycles, pre_move, move with collisions and
+    damage, then post_move.
+
+    >>> arena = Arena(10, 3, headless=True)
+    >>> rammer = arena.add_robot('rammer', 1, 1, [
+    ...     'copy @_desired_speed 10',
+    ...     'copy @_desired_heading 90',
+    ...     'halt'])
+    >>> target = arena.add_robot('target', 4, 1, ['halt'])
+    >>> arena.run(100)
+    Properties(health=[(1, 'rammer', 100), (2, 'target', 0)], ticks=12, winner='rammer')
+
+    Programs beyond the 256 words of memory robots have by default need a
+    larger memsize. Sparse robots share the program image and only keep the
+    cells they set:
+
+    >>> arena = Arena(10, 3, headless=True, memsize=1024, sparse=True)
+    >>> program = ['jump go', '@900', 'go:', 'copy @_desired_speed 10', 'copy @_desired_heading 90', 'halt']
+    >>> rammer = arena.add_robot('rammer', 1, 1, program)
+    >>> target = arena.add_robot('target', 4, 1, ['halt'])
+    >>> arena.run(100)
+    Properties(health=[(1, 'rammer', 100), (2, 'target', 0)], ticks=12, winner='rammer')
+    >>> sorted(dict(rammer.cpu.memory).items())[:2]
+    [(3, 10), (4, 90)]
+    '''
+    def __init__(self, width, height, walls=(), cycles=CYCLES_PER_TICK, engine=simcpu.FAST, headless=False,
+                 tracer=None, metrics=None, memsize=simcpu.MEMSIZE, registers=simcpu.REGISTERS, sparse=False):
+        '''
+        width, height -- Size in squares, everything outside is wall
+        walls -- Iterable of (x, y) wall squares inside the arena
+        cycles -- CPU cycles per robot per tick
+        engine -- simcpu engine running the robot programs
+        headless -- Don't print anything
+        tracer -- simcpu.TraceBuffer for the robot traces, robot ids are the trace ids
+        metrics -- metrics.Metrics collecting tick stage timings and cycle use
+        memsize, registers, sparse -- Memory words, registers and sparse memory of the robot Cpus
+        '''
+        self.width = width
+        self.height = height
+        self.walls = set(walls)
+        # Occupancy of every square: 0, robot id or WALL. The arena is padded
+        # with SCANNER_RANGE squares of wall so scanner rows are plain slices.
+        self.stride = width + 2 * SCANNER_RANGE
+        self.grid = [WALL] * (self.stride * (height + 2 * SCANNER_RANGE))
+        for y in xrange(height):
+            start = self.square(0, y)
+            self.grid[start:start + width] = [0] * width
+        for x, y in self.walls:
+            self.grid[self.square(x, y)] = WALL
+        self.cycles = cycles
+        self.engine = engine
+        self.out = simcpu.NoOutput() if headless else sys.stdout
+        self.tracer = tracer
+        self.metrics = metrics
+        self.memsize = memsize
+        self.registers = registers
+        self.sparse = sparse
+        self.robots = []
+        self.tick = 0
+        # Squares in grid that changed this tick, robots near them rescan
+        self.changed = []
+        # What robots ran into this tick, robot id or WALL by robot id
+        self.collisions = {}
+        # Ticks run skips because the game repeats, see run
+        self.skipped = 0
+
+    def add_robot(self, name, pos_x, pos_y, program):
+        '''Creates a robot running program at a square and returns it.'''
+        if self.grid[self.square(pos_x, pos_y)] != 0:
+            raise ValueError('Square %s, %s is not free' % (pos_x, pos_y))
+        robot = Robot(name, pos_x, pos_y, self.scan, program, self.engine, self.find_robot, self.memsize,
+                      self.registers, self.sparse)
+        robot.id = len(self.robots) + 1
+        self.grid[self.square(pos_x, pos_y)] = robot.id
+        self.changed.append(self.square(pos_x, pos_y))
+        robot.out = robot.cpu.out = self.out
+        robot.cpu.tracer = self.tracer
+        robot.cpu.trace_id = robot.id
+        self.robots.append(robot)
+        return robot
+
+    def free_squares(self, count, seed=0):
+        '''Picks count distinct squares that are not walls, repeatable by seed.'''
+        squares = [(x, y) for y in xrange(self.height) for x in xrange(self.width)
+                   if (x, y) not in self.walls]
+        return random.Random(seed).sample(squares, count)
+
+    def find_robot(self, ident):
+        '''The robot with id ident, None if there is none.'''
+        if 0 < ident <= len(self.robots):
+            return self.robots[ident - 1]
+        return None
+
+    def alive(self):
+        return [robot for robot in self.robots if robot.health > 0]
+
+    def square(self, x, y):
+        '''Index of a square in grid.'''
+        return (y + SCANNER_RANGE) * self.stride + x + SCANNER_RANGE
+
+    def is_wall(self, x, y):
+        if x < -SCANNER_RANGE or y < -SCANNER_RANGE or x >= self.width + SCANNER_RANGE or y >= self.height + SCANNER_RANGE:
+            return True
+        return self.grid[self.square(x, y)] == WALL
+
+    def robot_at(self, x, y):
+        if self.is_wall(x, y):
+            return None
+        occupant = self.grid[self.square(x, y)]
+        return self.robots[occupant - 1] if occupant else None
+
+    def scan(self, x, y, memory=None, start=0):
+        '''
+        Scanner grid around a square, see README. The grid is written to
+        memory from start a row at a time, a new list if memory is None.
+
+        >>> arena = Arena(3, 2, walls=[(2, 1)])
+        >>> robot = arena.add_robot('scanned', 1, 0, ['halt'])
+        >>> grid = arena.scan(1, 0)
+        >>> print '\\n'.join([''.join(map(str, grid[row:row + 7])) for row in xrange(0, 49, 7)])
+        WWWWWWW
+        WWWWWWW
+        WWWWWWW
+        WW010WW
+        WW00WWW
+        WWWWWWW
+        WWWWWWW
+        '''
+        if memory is None:
+            memory = [0] * SCANNER_GRID
+        grid = self.grid
+        size = 2 * SCANNER_RANGE + 1
+        row = self.square(x - SCANNER_RANGE, y - SCANNER_RANGE)
+        for offset in xrange(start, start + SCANNER_GRID, size):
+            memory[offset:offset + size] = grid[row:row + size]
+            row += self.stride
+        return memory
+
+    def run_tick(self):
+        robots = self.alive()
+        metrics = self.metrics
+        if metrics is None:
+            self.think(robots)
+            for robot in robots:
+                self.move(robot)
+            self.post_move()
+            return
+        start = metrics.timer()
+        self.think(robots)
+        metrics.collision_time = 0.0
+        moving = metrics.timer()
+        for robot in robots:
+            self.move(robot)
+        metrics.stages['move'].observe(metrics.timer() - moving - metrics.collision_time)
+        metrics.stages['collisions'].observe(metrics.collision_time)
+        self.post_move()
+        metrics.tick.observe(metrics.timer() - start)
+        metrics.ticks += 1
+
+    def think(self, robots):
+        '''CPU cycles and pre_move for robots, a robot program failing halts it.
+        Robots halted before the tick keep the speed and heading they had.'''
+        if self.tracer is not None:
+            self.tracer.tick = self.tick
+        self.collisions.clear()
+        robots = [robot for robot in robots if not robot.cpu.halted_flag]
+        metrics = self.metrics
+        if metrics is not None:
+            start = metrics.timer()
+        for robot in robots:
+            try:
+                used = robot.cpu_cycles(self.cycles)
+            except Exception as e:
+                self.out.write('%s: System halted: %s\n' % (robot.name, e))
+                robot.cpu.halted_flag = True
+            else:
+                if metrics is not None:
+                    metrics.robot_cycles(used, self.cycles)
+        if metrics is not None:
+            now = metrics.timer()
+            metrics.stages['cycles'].observe(now - start)
+            start = now
+        for robot in robots:
+            robot.pre_move()
+        if metrics is not None:
+            metrics.stages['pre_move'].observe(metrics.timer() - start)
+
+    def post_move(self):
+        '''post_move for the robots still alive and running, ends the tick.
+        Robots with a changed square in scanner range are marked to rescan.'''
+        if self.metrics is not None:
+            start = self.metrics.timer()
+        changed = [divmod(square, self.stride) for square in self.changed]
+        for robot in self.alive():
+            if robot.cpu.halted_flag:
+                continue
+            if changed and not robot.scan_dirty:
+                x, y = robot.pos_x // 10 + SCANNER_RANGE, robot.pos_y // 10 + SCANNER_RANGE
+                for changed_y, changed_x in changed:
+                    if abs(changed_x - x) <= SCANNER_RANGE and abs(changed_y - y) <= SCANNER_RANGE:
+                        robot.scan_dirty = True
+                        break
+            robot.post_move()
+        del self.changed[:]
+        self.tick += 1
+        if self.metrics is not None:
+            self.metrics.stages['post_move'].observe(self.metrics.timer() - start)
+
+    def move(self, robot):
+        '''Moves a robot, crashing it into walls or other robots.'''
+        if robot.health <= 0:
+            return
+        old_x, old_y = robot.pos_x, robot.pos_y
+        robot.move()
+        x, y = robot.pos_x // 10, robot.pos_y // 10
+        if (x, y) == (old_x // 10, old_y // 10):
+            return
+        occupant = WALL if self.is_wall(x, y) else self.grid[self.square(x, y)]
+        if occupant and self.metrics is not None:
+            start = self.metrics.timer()
+            self.collide(robot, occupant, old_x, old_y)
+            self.metrics.collision_time += self.metrics.timer() - start
+        elif occupant:
+            self.collide(robot, occupant, old_x, old_y)
+        else:
+            self.grid[self.square(old_x // 10, old_y // 10)] = 0
+            self.grid[self.square(x, y)] = robot.id
+            self.changed.extend((self.square(old_x // 10, old_y // 10), self.square(x, y)))
+
+    def collide(self, robot, occupant, old_x, old_y):
+        '''Puts robot back at old_x, old_y after running into occupant, a
+        wall or a robot id, and deals the damage.'''
+        robot.pos_x, robot.pos_y = old_x, old_y
+        self.collisions[robot.id] = occupant
+        if occupant == WALL:
+            self.damage(robot, robot.speed)
+            robot.speed = 0
+        else:
+            self.crash(robot, self.robots[occupant - 1])
+
+    def crash(self, attacker, target):
+        '''Damage and speed/heading swap when attacker runs into target.'''
+        if attacker.heading == target.heading:
+            self.damage(target, max(0, attacker.speed - target.speed))
+        elif attacker.heading == (target.heading + 180) % 360:
+            self.damage(target, attacker.speed)
+            self.damage(attacker, target.speed)
+        else:
+            self.damage(target, attacker.speed)
+        attacker.speed, target.speed = target.speed, attacker.speed
+        attacker.heading, target.heading = target.heading, attacker.heading
+
+    def damage(self, robot, amount):
+        robot.health = max(0, robot.health - amount)
+        if robot.health <= 0:
+            self.grid[self.square(robot.pos_x // 10, robot.pos_y // 10)] = 0
+            self.changed.append(self.square(robot.pos_x // 10, robot.pos_y // 10))
+
+    def done(self, ticks):
+        '''True when a single robot is left or ticks ticks have been run.'''
+        return self.tick >= ticks or len(self.alive()) <= 1
+
+    def run(self, ticks, progress=None):
+        '''
+        Runs until done, returns the result. progress is called with the
+        arena after every tick. A game back in a state it was
+        in before repeats forever without anyone losing health, so the rest
+        of the ticks are skipped, unless a tracer records them. States are
+        compared with those at ticks doubling in distance (Brent's cycle
+        detection), the robot CPU states only when the physical ones match.
+
+        >>> arena = Arena(6, 6, headless=True)
+        >>> spinner = arena.add_robot('spinner', 1, 1, [
+        ...     'copy @_desired_speed 5', 'loop:', 'compute @_desired_heading + @_heading 90', 'jump loop'])
+        >>> sitter = arena.add_robot('sitter', 4, 4, ['halt'])
+        >>> arena.run(1000000)
+        Properties(health=[(1, 'spinner', 100), (2, 'sitter', 100)], ticks=1000000, winner=None)
+        >>> arena.skipped > 999000
+        True
+        '''
+        saved = None
+        power = length = 1
+        while not self.done(ticks):
+            self.run_tick()
+            if self.tracer is None:
+                physical = [robot.physical_state() for robot in self.robots]
+                if (saved is not None and physical == saved[0]
+                        and [robot.cpu_state() for robot in self.robots] == saved[1]):
+                    self.skipped += ticks - self.tick
+                    self.tick = ticks
+                elif length == power:
+                    saved = physical, [robot.cpu_state() for robot in self.robots]
+                    power *= 2
+                    length = 1
+                else:
+                    length += 1
+            if progress is not None:
+                progress(self)
+        return self.result()
+
+    def checkpoint(self):
+        '''
+        The state of the game between ticks, for restore. Robots can't be
+        added before restoring it.
+
+        >>> arena = Arena(6, 6, headless=True)
+        >>> for x, y in [(0, 0), (5, 0), (0, 5)]:
+        ...     robot = arena.add_robot('bot', x, y, [
+        ...         'copy @_desired_speed 6', 'loop:', 'compute @_desired_heading + @_heading 90', 'jump loop'])
+        >>> arena.run(5).ticks
+        5
+        >>> checkpoint = arena.checkpoint()
+        >>> first = arena.run(200)
+        >>> arena.restore(checkpoint)
+        >>> arena.tick, repr(arena.run(200)) == repr(first)
+        (5, True)
+        '''
+        robots = [(tuple([getattr(robot, field) for field in CHECKPOINT_FIELDS]), robot.cpu.snapshot())
+                  for robot in self.robots]
+        return Properties(tick=self.tick, grid=tuple(self.grid), changed=tuple(self.changed),
+                          collisions=dict(self.collisions), robots=robots)
+
+    def restore(self, checkpoint):
+        '''Puts back the game state from checkpoint.'''
+        self.tick = checkpoint.tick
+        self.grid[:] = checkpoint.grid
+        self.changed[:] = checkpoint.changed
+        self.collisions.clear()
+        self.collisions.update(checkpoint.collisions)
+        for robot, (values, state) in zip(self.robots, checkpoint.robots):
+            for field, value in zip(CHECKPOINT_FIELDS, values):
+                setattr(robot, field, value)
+            robot.cpu.restore(state)
+
+    def result(self):
+        '''Winner is the last robot standing, or the single healthiest one.'''
+        health = [(robot.id, robot.name, robot.health) for robot in self.robots]
+        best = max([robot.health for robot in self.robots])
+        leaders = [robot for robot in self.robots if robot.health == best]
+        winner = leaders[0].name if len(leaders) == 1 else None
+        return Properties(winner=winner, ticks=self.tick, health=health)
+
+def empty_scanner(x, y, memory, start):
+    memory[start:start + SCANNER_GRID] = [0] * SCANNER_GRID
 
 if __name__ == '__main__':
-    rob = Robot('test', 10, 10, empty_scanner, '''
-    trace
-copy @_desired_speed 1
-copy R0 0
-loop:
-copy @_desired_heading R0
-compute R0 + R0 1
-test R0 < 360
-jumpif loop
-halt
-    '''.split('\n'))
-    while not rob.cpu.halted_flag:
-        print "STILL NOT HALTED"
-        rob.cpu_cycles(30)
-        rob.pre_move()
-        rob.move()
-        rob.post_move()
-    print rob
-    print rob.cpu
+    if len(sys.argv) < 2:
+        sys.stderr.write('Usage: %s <robot 1 program> [<robot 2 program> ...]\n' % sys.argv[0])
+        sys.exit(1)
+    arena = Arena(20, 20)
+    for (x, y), filename in zip(arena.free_squares(len(sys.argv) - 1), sys.argv[1:]):
+        with simcpu.open_source(filename) as f:
+            arena.add_robot(filename, x, y, f)
+    print arena.run(1000)
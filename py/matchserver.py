@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+'''
+A long running crashbots match service. Clients connect over a Unix socket
+or localhost TCP and send match requests as JSON lines, progress and
+results stream back as JSON lines. Matches are played by a pool of worker
+processes started once with the robot programs of a directory already
+parsed, so a match costs little more than its simulation.
+
+Request, every field but bots is optional:
+
+    {"bots": [<name> or [<name>, <program lines>], ...], "seed": 0,
+     "width": 20, "height": 20, "ticks": 1000, "progress": 0}
+
+With progress set to n a progress line is sent every n ticks. Responses
+carry the id the server gave the request, ids are handed out in the order
+requests arrive:
+
+    {"id": 1, "queued": ["a", "b"]}
+    {"id": 1, "tick": 100, "health": [100, 90]}
+    {"id": 1, "result": <see tournament.play>}
+    {"id": 1, "error": "..."}
+
+The connection is closed once the client has closed its side and every
+request it sent is finished.
+
+Usage: matchserver.py <bot directory> [options], see --help
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import Queue
+import SocketServer
+import multiprocessing
+import simcpu
+import crashbots
+import tournament
+
+## Seconds to wait for more requests to batch with the first one
+BATCH_WAIT = 0.01
+## Most requests in a batch, each batch is split over the workers
+BATCH_SIZE = 64
+## Match settings used when a request leaves them out
+DEFAULTS = {'seed': 0, 'width': tournament.WIDTH, 'height': tournament.HEIGHT, 'ticks': tournament.TICKS,
+            'progress': 0}
+
+## Robot programs by name and the queue for progress and results, set in
+## every worker process by warm_worker
+worker_bots = {}
+worker_events = None
+
+def warm_worker(bots, events):
+    '''Pool initializer, parses every robot program once so the robots of
+    every match load it from the Cpu image cache.'''
+    global worker_bots, worker_events
+    worker_bots, worker_events = bots, events
+    for name, program in bots.iteritems():
+        try:
+            simcpu.Cpu(name).load(crashbots.Robot.base_program + program)
+        except simcpu.ParseException:
+            pass
+
+def play_batch(batch):
+    '''Plays a list of (id, request) in a worker, sending progress, results
+    and errors as (id, response, finished) to worker_events.'''
+    for ident, request in batch:
+        every = request['progress']
+        def progress(arena):
+            if every and arena.tick % every == 0:
+                worker_events.put((ident, {'tick': arena.tick, 'health': [robot.health for robot in arena.robots]},
+                                   False))
+        try:
+            bots = [bot if isinstance(bot, tuple) else (bot, worker_bots[bot]) for bot in request['bots']]
+            result = tournament.play((ident, request['seed'], bots, request), progress)
+            worker_events.put((ident, {'result': result}, True))
+        except Exception as e:
+            worker_events.put((ident, {'error': '%s: %s' % (type(e).__name__, e)}, True))
+
+def check_request(request, bots):
+    '''
+    The request with defaults filled in and inline programs as tuples of
+    lines. Raises ValueError if it can't be played.
+
+    >>> check_request({'bots': ['a', ['b', ['halt']]], 'ticks': 10}, {'a': ['halt']})['bots']
+    ['a', ('b', ['halt'])]
+    >>> check_request({'bots': ['c']}, {'a': ['halt']})
+    Traceback (most recent call last):
+    ValueError: Unknown bot c
+    '''
+    if not isinstance(request, dict) or not isinstance(request.get('bots'), list) or not request['bots']:
+        raise ValueError('Request needs a list of bots')
+    res = dict(DEFAULTS)
+    for key in DEFAULTS:
+        if key in request:
+            if not isinstance(request[key], int):
+                raise ValueError(key + ' must be an integer')
+            res[key] = request[key]
+    res['bots'] = []
+    for bot in request['bots']:
+        if isinstance(bot, list) and len(bot) == 2 and isinstance(bot[1], list):
+            res['bots'].append((bot[0].encode('utf-8'), [line.encode('utf-8') for line in bot[1]]))
+        elif bot in bots:
+            res['bots'].append(str(bot))
+        else:
+            raise ValueError('Unknown bot ' + str(bot))
+    return res
+
+class Client(object):
+    '''A connection, counts the requests not finished. Responses are
+    written by a thread of its own, so a client that stops reading only
+    holds up itself.'''
+    def __init__(self, out):
+        self.out = out
+        self.pending = 0
+        self.lock = threading.Condition()
+        self.responses = Queue.Queue()
+        self.writer = threading.Thread(target=self.write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def send(self, ident, response, finished=False):
+        '''Queues a response, finished when it is the last for the request.'''
+        self.responses.put((ident, response, finished))
+
+    def write(self):
+        '''Writes the queued responses until close.'''
+        for ident, response, finished in iter(self.responses.get, None):
+            try:
+                self.out.write(json.dumps(dict(response, id=ident), sort_keys=True) + '\n')
+                self.out.flush()
+            except socket.error:
+                pass
+            if finished:
+                with self.lock:
+                    self.pending -= 1
+                    self.lock.notify_all()
+
+    def wait(self):
+        '''Blocks until every request is finished and its responses written.'''
+        with self.lock:
+            while self.pending:
+                self.lock.wait()
+
+    def close(self):
+        '''Stops the writer once the queued responses are written.'''
+        self.responses.put(None)
+        self.writer.join()
+
+class Matches(object):
+    '''
+    The worker pool and the threads feeding it requests and passing its
+    progress and results to the clients.
+    '''
+    def __init__(self, bots, processes=None, batch_size=BATCH_SIZE):
+        self.bots = bots
+        self.processes = processes or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.events = multiprocessing.Queue()
+        self.pool = multiprocessing.Pool(self.processes, warm_worker, (bots, self.events))
+        self.requests = Queue.Queue()
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.next_id = 1
+        for target in self.dispatch, self.deliver:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, request, client):
+        '''Queues a request from client, answering right away if it is invalid.'''
+        with self.lock:
+            ident = self.next_id
+            self.next_id += 1
+        with client.lock:
+            client.pending += 1
+        try:
+            request = check_request(request, self.bots)
+        except (ValueError, TypeError, AttributeError) as e:
+            client.send(ident, {'error': str(e)}, True)
+            return
+        client.send(ident, {'queued': [bot if isinstance(bot, str) else bot[0] for bot in request['bots']]})
+        with self.lock:
+            self.clients[ident] = client
+        self.requests.put((ident, request))
+
+    def dispatch(self):
+        '''Collects the requests arriving within BATCH_WAIT of each other
+        and splits them over the workers.'''
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.time() + BATCH_WAIT
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.requests.get(timeout=max(0, deadline - time.time())))
+                except Queue.Empty:
+                    break
+            count = min(self.processes, len(batch))
+            for index in xrange(count):
+                self.pool.apply_async(play_batch, (batch[index::count],))
+
+    def deliver(self):
+        '''Passes worker progress and results to the clients.'''
+        while True:
+            ident, response, finished = self.events.get()
+            with self.lock:
+                client = self.clients.pop(ident) if finished else self.clients.get(ident)
+            if client is not None:
+                client.send(ident, response, finished)
+
+    def close(self):
+        self.pool.terminate()
+
+class MatchHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        client = Client(self.wfile)
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                request = 'Invalid JSON: ' + str(e)
+            self.server.matches.submit(request, client)
+        client.wait()
+        client.close()
+
+class UnixMatchServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class TCPMatchServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def serve(address, bots, processes=None, batch_size=BATCH_SIZE):
+    '''
+    A server for address, a Unix socket path or a (host, port) pair,
+    playing matches between bots, robot programs by name. Run it with
+    serve_forever, close stops it and its workers.
+
+    >>> import shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, 'socket')
+    >>> server = serve(path, {'runner': ['copy @_desired_speed 10', 'halt'], 'sitter': ['halt']}, 1)
+    >>> thread = threading.Thread(target=server.serve_forever)
+    >>> thread.start()
+    >>> responses = request_matches(path, [
+    ...     {'bots': ['runner', 'sitter'], 'seed': 1, 'width': 5, 'height': 5, 'ticks': 50, 'progress': 5},
+    ...     {'bots': ['runner', 'walker']},
+    ...     {'bots': [['spinner', ['loop:', 'compute @_desired_heading + @_heading 90', 'jump loop']]],
+    ...      'ticks': 20}])
+    >>> for response in sorted(responses, key=lambda response: response['id']):
+    ...     print json.dumps(response, sort_keys=True)
+    {"id": 1, "queued": ["runner", "sitter"]}
+    {"health": [50, 100], "id": 1, "tick": 5}
+    {"health": [0, 100], "id": 1, "tick": 10}
+    {"id": 1, "result": {"bots": ["runner", "sitter"], "health": [0, 100], "match": 1, "seed": 1, "ticks": 10, "winner": "sitter"}}
+    {"error": "Unknown bot walker", "id": 2}
+    {"id": 3, "queued": ["spinner"]}
+    {"id": 3, "result": {"bots": ["spinner"], "health": [100], "match": 3, "seed": 0, "ticks": 0, "winner": "spinner"}}
+    >>> server.shutdown()
+    >>> thread.join()
+    >>> server.close()
+    >>> shutil.rmtree(directory)
+    '''
+    if isinstance(address, tuple):
+        server = TCPMatchServer(address, MatchHandler)
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = UnixMatchServer(address, MatchHandler)
+    server.matches = Matches(bots, processes, batch_size)
+    def close():
+        server.server_close()
+        server.matches.close()
+        if not isinstance(address, tuple) and os.path.exists(address):
+            os.unlink(address)
+    server.close = close
+    return server
+
+def connect(address):
+    '''A socket connected to a server at address, see serve.'''
+    if isinstance(address, tuple):
+        return socket.create_connection(address)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+def request_matches(address, requests):
+    '''Sends requests to the server at address and yields the responses as
+    they arrive, until every request is finished.'''
+    sock = connect(address)
+    try:
+        sock.sendall(''.join([json.dumps(request) + '\n' for request in requests]))
+        sock.shutdown(socket.SHUT_WR)
+        for line in iter(sock.makefile().readline, ''):
+            yield json.loads(line)
+    finally:
+        sock.close()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Serves crashbots matches to clients.')
+    parser.add_argument('directory', nargs='?', help='directory of robot programs to serve')
+    parser.add_argument('--socket', metavar='PATH', help='Unix socket to listen on or connect to')
+    parser.add_argument('--port', type=int, help='localhost TCP port to listen on or connect to')
+    parser.add_argument('--processes', type=int, help='worker processes (default: one per core)')
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE,
+                        help='most requests batched together (default: %(default)s)')
+    parser.add_argument('--connect', action='store_true',
+                        help='send the JSON line requests on stdin to a server and print the responses')
+    args = parser.parse_args(argv)
+    if (args.socket is None) == (args.port is None):
+        parser.error('give either --socket or --port')
+    address = args.socket or ('127.0.0.1', args.port)
+    if args.connect:
+        for response in request_matches(address, [json.loads(line) for line in sys.stdin if line.strip()]):
+            print json.dumps(response, sort_keys=True)
+        return
+    if not args.directory:
+        parser.error('give the directory of robot programs to serve')
+    server = serve(address, tournament.load_bots(args.directory), args.processes, args.batch)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
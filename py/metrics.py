@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+'''
+Timings of the crashbots tick stages and robot cycle use, collected by
+an Arena given a Metrics. Histograms follow Prometheus: bucket counts by
+upper bound, plus the sum and count of everything observed. Metrics are
+exported as JSON or Prometheus text and can be merged, so the metrics of
+matches played in different processes add up.
+
+    >>> import crashbots
+    >>> metrics = Metrics()
+    >>> arena = crashbots.Arena(6, 1, headless=True, metrics=metrics)
+    >>> rammer = arena.add_robot('rammer', 0, 0, ['copy @_desired_speed 10', 'copy @_desired_heading 90', 'halt'])
+    >>> target = arena.add_robot('target', 3, 0, ['loop:', 'jump loop'])
+    >>> arena.run(100).ticks
+    12
+    >>> metrics.ticks, metrics.stages['cycles'].count, metrics.cycles, metrics.budget
+    (12, 12, 364, 390)
+    >>> metrics.cycle_use.counts
+    [0, 1, 0, 0, 0, 12, 0]
+    >>> print '\\n'.join([line for line in metrics.prometheus().split('\\n') if 'cycle_use' in line])
+    # HELP crashbots_cycle_use_ratio Share of the cycle budget a robot used in a tick
+    # TYPE crashbots_cycle_use_ratio histogram
+    crashbots_cycle_use_ratio_bucket{le="0.1"} 0
+    crashbots_cycle_use_ratio_bucket{le="0.25"} 1
+    crashbots_cycle_use_ratio_bucket{le="0.5"} 1
+    crashbots_cycle_use_ratio_bucket{le="0.75"} 1
+    crashbots_cycle_use_ratio_bucket{le="0.9"} 1
+    crashbots_cycle_use_ratio_bucket{le="1"} 13
+    crashbots_cycle_use_ratio_bucket{le="+Inf"} 13
+    crashbots_cycle_use_ratio_sum 12.13333333
+    crashbots_cycle_use_ratio_count 13
+'''
+
+import bisect
+import timeit
+
+## Bucket upper bounds in seconds for stage and tick wall times
+TIME_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1)
+## Bucket upper bounds for the share of the cycle budget used
+USE_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 1.0)
+## Tick stages in order: robot CPU cycles, reading the robot controls,
+## moving, resolving crashes into walls and robots (not part of move) and
+## writing robot state and scanners back
+STAGES = ('cycles', 'pre_move', 'move', 'collisions', 'post_move')
+
+class Histogram(object):
+    '''
+    Observations counted in buckets by upper bound, the last bucket has no
+    bound.
+
+    >>> histogram = Histogram((1, 5))
+    >>> for value in 0.5, 1, 3, 10:
+    ...     histogram.observe(value)
+    >>> histogram.counts, histogram.sum, histogram.count
+    ([2, 1, 1], 14.5, 4)
+    '''
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        '''Adds the observations of other, which must have the same bounds.'''
+        self.counts = map(sum, zip(self.counts, other.counts))
+        self.sum += other.sum
+        self.count += other.count
+
+    def json(self):
+        return {'bounds': list(self.bounds), 'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+    def prometheus(self, name, labels=''):
+        '''Prometheus text lines for the histogram, labels are extra
+        label="value" pairs.'''
+        res = []
+        total = 0
+        for bound, count in zip(list(self.bounds) + ['+Inf'], self.counts):
+            total += count
+            res.append('%s_bucket{%sle="%s"} %d' % (name, labels + ',' if labels else '', format_value(bound), total))
+        braces = '{' + labels + '}' if labels else ''
+        res.append('%s_sum%s %s' % (name, braces, format_value(self.sum)))
+        res.append('%s_count%s %d' % (name, braces, self.count))
+        return res
+
+def format_value(value):
+    return value if isinstance(value, str) else '%.10g' % value
+
+class Metrics(object):
+    '''
+    Tick stage wall times, tick wall times and the share of the cycle
+    budget each running robot used per tick. Arena only looks at the
+    clock when it has a Metrics. Physics moves robots itself, so its move
+    and collisions stages and tick times are not recorded.
+    '''
+    def __init__(self):
+        self.timer = timeit.default_timer
+        self.stages = dict([(stage, Histogram(TIME_BUCKETS)) for stage in STAGES])
+        self.tick = Histogram(TIME_BUCKETS)
+        self.cycle_use = Histogram(USE_BUCKETS)
+        self.ticks = 0
+        self.cycles = 0
+        self.budget = 0
+        # Collision seconds of the tick running, see Arena.move
+        self.collision_time = 0.0
+
+    def robot_cycles(self, used, budget):
+        self.cycle_use.observe(float(used) / budget)
+        self.cycles += used
+        self.budget += budget
+
+    def ticks_per_second(self):
+        return self.ticks / self.tick.sum if self.tick.sum else 0.0
+
+    def merge(self, other):
+        '''Adds the metrics collected in other.'''
+        for stage in STAGES:
+            self.stages[stage].merge(other.stages[stage])
+        self.tick.merge(other.tick)
+        self.cycle_use.merge(other.cycle_use)
+        self.ticks += other.ticks
+        self.cycles += other.cycles
+        self.budget += other.budget
+
+    def json(self):
+        '''The metrics as a dict for JSON.'''
+        return {'stages': dict([(stage, self.stages[stage].json()) for stage in STAGES]),
+                'tick': self.tick.json(), 'cycle_use': self.cycle_use.json(), 'ticks': self.ticks,
+                'cycles': self.cycles, 'budget': self.budget, 'ticks_per_second': self.ticks_per_second()}
+
+    def prometheus(self):
+        '''The metrics in the Prometheus text format.'''
+        res = ['# HELP crashbots_stage_seconds Wall time of a tick stage',
+               '# TYPE crashbots_stage_seconds histogram']
+        for stage in STAGES:
+            res.extend(self.stages[stage].prometheus('crashbots_stage_seconds', 'stage="%s"' % stage))
+        res.extend(['# HELP crashbots_tick_seconds Wall time of a tick',
+                    '# TYPE crashbots_tick_seconds histogram'])
+        res.extend(self.tick.prometheus('crashbots_tick_seconds'))
+        res.extend(['# HELP crashbots_cycle_use_ratio Share of the cycle budget a robot used in a tick',
+                    '# TYPE crashbots_cycle_use_ratio histogram'])
+        res.extend(self.cycle_use.prometheus('crashbots_cycle_use_ratio'))
+        res.extend(['# HELP crashbots_cycles_total CPU cycles run by robots',
+                    '# TYPE crashbots_cycles_total counter',
+                    'crashbots_cycles_total %d' % self.cycles,
+                    '# HELP crashbots_cycles_budget_total CPU cycles robots could have run',
+                    '# TYPE crashbots_cycles_budget_total counter',
+                    'crashbots_cycles_budget_total %d' % self.budget,
+                    '# HELP crashbots_ticks_per_second Ticks per second of tick wall time',
+                    '# TYPE crashbots_ticks_per_second gauge',
+                    'crashbots_ticks_per_second %s' % format_value(self.ticks_per_second())])
+        return '\n'.join(res) + '\n'
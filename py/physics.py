@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+'''
+Batched movement, walls, crashes and damage for the robots of one or many
+crashbots arenas. Positions, speeds, headings and health of every robot
+live in arrays and the robot CPUs only hand over their desired speed and
+heading. Uses NumPy when it is installed, otherwise the same rules run
+robot by robot.
+'''
+
+import crashbots
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+## Grid value for walls, robots are their index + 1
+WALL = -1
+## Movement per heading // 90
+DX = (0, 1, 0, -1)
+DY = (-1, 0, 1, 0)
+## Scanner padding around every arena, see crashbots.Arena.grid
+PAD = crashbots.SCANNER_RANGE
+
+class Physics(object):
+    '''
+    Runs the ticks of many arenas in lockstep with the move stage done for
+    all robots at once. Gives the same results as Arena.run, except that
+    headings are always integers and no HEADING lines are written, so it is
+    meant for headless arenas.
+
+    >>> def arena(seed):
+    ...     arena = crashbots.Arena(6, 6, walls=[(3, 3)], headless=True)
+    ...     for (x, y), program in zip(arena.free_squares(3, seed), [
+    ...             ['copy @_desired_speed 10', 'halt'],
+    ...             ['copy @_desired_speed 5', 'loop:', 'compute @_desired_heading + @_desired_heading 90', 'jump loop'],
+    ...             ['copy @_desired_speed 7', 'copy @_desired_heading 90', 'halt']]):
+    ...         arena.add_robot('bot', x, y, program)
+    ...     return arena
+    >>> expected = [repr(arena(seed).run(40)) for seed in xrange(4)]
+    >>> results = Physics([arena(seed) for seed in xrange(4)]).run(40)
+    >>> map(repr, results) == expected
+    True
+    >>> results[2]
+    Properties(health=[(1, 'bot', 0), (2, 'bot', 100), (3, 'bot', 0)], ticks=18, winner='bot')
+    '''
+    def __init__(self, arenas, use_numpy=True):
+        self.arenas = list(arenas)
+        self.numpy = numpy is not None and use_numpy
+        self.robots = []
+        grid = []
+        base = []
+        stride = []
+        for arena in self.arenas:
+            first = len(self.robots)
+            for value in arena.grid:
+                grid.append(WALL if value == crashbots.WALL else value and first + value)
+            for robot in arena.robots:
+                base.append(len(grid) - len(arena.grid))
+                stride.append(arena.stride)
+            self.robots.extend(arena.robots)
+        count = len(self.robots)
+        self.grid = self.array(grid)
+        self.base = self.array(base)
+        self.stride = self.array(stride)
+        self.pos_x = self.array([robot.pos_x for robot in self.robots])
+        self.pos_y = self.array([robot.pos_y for robot in self.robots])
+        self.speed = self.array([robot.speed for robot in self.robots])
+        self.heading = self.array([robot.heading for robot in self.robots])
+        self.health = self.array([robot.health for robot in self.robots])
+        self.want_speed = self.array([0] * count)
+        self.want_heading = self.array([0] * count)
+        self.active = [False] * count
+        self.arena_of = []
+        for arena in self.arenas:
+            self.arena_of.extend([arena] * len(arena.robots))
+
+    def array(self, values):
+        return numpy.array(values, dtype=numpy.int64) if self.numpy else list(values)
+
+    def cell(self, index, x, y):
+        return self.base[index] + (y // 10 + PAD) * self.stride[index] + x // 10 + PAD
+
+    def run(self, ticks):
+        '''Runs every arena until it is done, returns the results in arena order.'''
+        while self.run_tick(ticks):
+            pass
+        return [arena.result() for arena in self.arenas]
+
+    def run_tick(self, ticks):
+        '''Runs a tick of every arena that is not done, returns False when all are.'''
+        arenas = [arena for arena in self.arenas if not arena.done(ticks)]
+        if not arenas:
+            return False
+        running = set(arenas)
+        for arena in arenas:
+            arena.think(arena.alive())
+        self.active = [arena in running and robot.health > 0
+                       for arena, robot in zip(self.arena_of, self.robots)]
+        self.step()
+        for arena in arenas:
+            arena.post_move()
+        return True
+
+    def step(self):
+        '''Moves every active robot, takes the desired speed and heading
+        from the robots and updates them with the outcome.'''
+        for index, robot in enumerate(self.robots):
+            if self.active[index]:
+                self.want_speed[index] = max(0, min(crashbots.TOP_SPEED, int(robot.desired_speed)))
+                self.want_heading[index] = int(((robot.desired_heading % 360) // 90) * 90)
+        if self.numpy:
+            self.step_numpy()
+        else:
+            for index in xrange(len(self.robots)):
+                if self.active[index]:
+                    self.move(index)
+        for index, robot in enumerate(self.robots):
+            if self.active[index]:
+                robot.pos_x = int(self.pos_x[index])
+                robot.pos_y = int(self.pos_y[index])
+                robot.speed = int(self.speed[index])
+                robot.heading = int(self.heading[index])
+                robot.health = int(self.health[index])
+
+    def step_numpy(self):
+        '''
+        Robots that can't interact with each other this tick are moved as
+        arrays: those that stay in their square, and those moving into a
+        square that is empty or a wall, that no other robot moves into and
+        whose own square no robot moves into. The rest run robot by robot in
+        order, exactly as in Arena.move.
+        '''
+        index = numpy.nonzero(numpy.array(self.active, dtype=bool) & (self.health > 0))[0]
+        speed = self.want_speed[index]
+        heading = self.want_heading[index]
+        new_x = self.pos_x[index] + numpy.take(DX, heading // 90) * speed
+        new_y = self.pos_y[index] + numpy.take(DY, heading // 90) * speed
+        old = self.base[index] + (self.pos_y[index] // 10 + PAD) * self.stride[index] + self.pos_x[index] // 10 + PAD
+        new = self.base[index] + (new_y // 10 + PAD) * self.stride[index] + new_x // 10 + PAD
+        moving = new != old
+        occupant = self.grid[new]
+        targets = new[moving]
+        cells, inverse, counts = numpy.unique(targets, return_inverse=True, return_counts=True)
+        shared = numpy.zeros(len(index), dtype=bool)
+        shared[moving] = counts[inverse] > 1
+        ordered = (moving & ((occupant > 0) | shared)) | numpy.in1d(old, targets)
+        free = ~ordered
+        # Staying in the same square
+        stay = free & ~moving
+        self.pos_x[index[stay]] = new_x[stay]
+        self.pos_y[index[stay]] = new_y[stay]
+        # Moving into an empty square
+        go = free & moving & (occupant == 0)
+        self.pos_x[index[go]] = new_x[go]
+        self.pos_y[index[go]] = new_y[go]
+        self.grid[old[go]] = 0
+        self.grid[new[go]] = index[go] + 1
+        for robot, before, after in zip(index[go], old[go], new[go]):
+            arena = self.arena_of[robot]
+            arena.grid[before - self.base[robot]] = 0
+            arena.grid[after - self.base[robot]] = self.robots[robot].id
+            arena.changed.extend((before - self.base[robot], after - self.base[robot]))
+        # Crashing into a wall
+        crash = free & moving & (occupant == WALL)
+        self.health[index[crash]] = numpy.maximum(0, self.health[index[crash]] - speed[crash])
+        speed[crash] = 0
+        for robot, square in zip(index[crash], old[crash]):
+            self.arena_of[robot].collisions[self.robots[robot].id] = crashbots.WALL
+            if self.health[robot] <= 0:
+                self.clear(robot, square)
+        self.speed[index[free]] = speed[free]
+        self.heading[index[free]] = heading[free]
+        for robot in index[ordered]:
+            self.move(robot)
+
+    def move(self, index):
+        '''Moves a single robot, see Arena.move.'''
+        if self.health[index] <= 0:
+            return
+        self.speed[index] = self.want_speed[index]
+        self.heading[index] = self.want_heading[index]
+        old_x, old_y = self.pos_x[index], self.pos_y[index]
+        self.pos_x[index] += DX[self.heading[index] // 90] * self.speed[index]
+        self.pos_y[index] += DY[self.heading[index] // 90] * self.speed[index]
+        old = self.cell(index, old_x, old_y)
+        new = self.cell(index, self.pos_x[index], self.pos_y[index])
+        if old == new:
+            return
+        occupant = self.grid[new]
+        if occupant == WALL:
+            self.pos_x[index], self.pos_y[index] = old_x, old_y
+            self.arena_of[index].collisions[self.robots[index].id] = crashbots.WALL
+            self.damage(index, self.speed[index])
+            self.speed[index] = 0
+        elif occupant:
+            self.pos_x[index], self.pos_y[index] = old_x, old_y
+            self.arena_of[index].collisions[self.robots[index].id] = self.robots[occupant - 1].id
+            self.crash(index, occupant - 1)
+        else:
+            arena = self.arena_of[index]
+            self.grid[old] = 0
+            self.grid[new] = index + 1
+            arena.grid[old - self.base[index]] = 0
+            arena.grid[new - self.base[index]] = self.robots[index].id
+            arena.changed.extend((old - self.base[index], new - self.base[index]))
+
+    def crash(self, attacker, target):
+        '''See Arena.crash.'''
+        speed, heading = self.speed, self.heading
+        if heading[attacker] == heading[target]:
+            self.damage(target, max(0, speed[attacker] - speed[target]))
+        elif heading[attacker] == (heading[target] + 180) % 360:
+            self.damage(target, speed[attacker])
+            self.damage(attacker, speed[target])
+        else:
+            self.damage(target, speed[attacker])
+        speed[attacker], speed[target] = speed[target], speed[attacker]
+        heading[attacker], heading[target] = heading[target], heading[attacker]
+
+    def damage(self, index, amount):
+        self.health[index] = max(0, self.health[index] - amount)
+        if self.health[index] <= 0:
+            self.clear(index, self.cell(index, self.pos_x[index], self.pos_y[index]))
+
+    def clear(self, index, cell):
+        '''Removes a dead robot from the grids. Its health is written back
+        to the robot right away so the arena knows it is gone.'''
+        self.grid[cell] = 0
+        self.arena_of[index].grid[cell - self.base[index]] = 0
+        self.arena_of[index].changed.append(cell - self.base[index])
+        self.robots[index].health = 0
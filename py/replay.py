@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+'''
+Binary crashbots replays. A replay is a header with the arena size and
+robot names followed by one fixed size frame per tick, so any tick can be
+read without reading or simulating the ones before it.
+
+Header: HEADER, then for every robot its name length as NAME_LENGTH and
+the name. Frame: FRAME_TICK, then ROBOT_STATE for every robot in id
+order. Frame 0 is the state before the first tick, frame n the state
+after tick n.
+
+Usage: replay.py <replay file> [<tick>], prints the replay or a tick.
+'''
+
+import sys
+import mmap
+import struct
+import crashbots
+
+## Magic, format version, robot count, arena width and height
+HEADER = struct.Struct('<4sHHHH')
+MAGIC = 'CBRP'
+VERSION = 1
+NAME_LENGTH = struct.Struct('<H')
+## Tick number
+FRAME_TICK = struct.Struct('<I')
+## pos_x, pos_y, speed, heading, health and what the robot ran into during
+## the tick: 0, a robot id or COLLISION_WALL
+ROBOT_STATE = struct.Struct('<hhBHhH')
+COLLISION_WALL = 0xffff
+
+class ReplayWriter(object):
+    '''
+    Streams the frames of an arena to out, a binary file. The header is
+    written right away so robots can't be added afterwards.
+
+    >>> from StringIO import StringIO
+    >>> arena = crashbots.Arena(6, 1, headless=True)
+    >>> rammer = arena.add_robot('rammer', 0, 0, ['copy @_desired_speed 10', 'copy @_desired_heading 90', 'halt'])
+    >>> target = arena.add_robot('target', 3, 0, ['halt'])
+    >>> out = StringIO()
+    >>> writer = ReplayWriter(out, arena)
+    >>> while not arena.done(100):
+    ...     arena.run_tick()
+    ...     writer.write()
+    >>> replay = Replay(out.getvalue())
+    >>> len(replay), replay.names, replay.width, replay.height
+    (13, ['rammer', 'target'], 6, 1)
+    >>> replay[2]
+    [Properties(collision=0, heading=90, health=100, id=1, pos_x=20, pos_y=0, speed=10), Properties(collision=0, heading=0, health=100, id=2, pos_x=30, pos_y=0, speed=0)]
+    >>> replay[3]
+    [Properties(collision=2, heading=0, health=100, id=1, pos_x=20, pos_y=0, speed=0), Properties(collision=0, heading=0, health=90, id=2, pos_x=30, pos_y=0, speed=0)]
+    >>> replay[-1][1].health
+    0
+    '''
+    def __init__(self, out, arena):
+        self.out = out
+        self.arena = arena
+        header = [HEADER.pack(MAGIC, VERSION, len(arena.robots), arena.width, arena.height)]
+        for robot in arena.robots:
+            name = str(robot.name)
+            header.append(NAME_LENGTH.pack(len(name)) + name)
+        out.write(''.join(header))
+        self.write()
+
+    def write(self):
+        '''Writes the frame for the current arena tick.'''
+        collisions = self.arena.collisions
+        frame = [FRAME_TICK.pack(self.arena.tick)]
+        for robot in self.arena.robots:
+            collision = collisions.get(robot.id, 0)
+            frame.append(ROBOT_STATE.pack(robot.pos_x, robot.pos_y, robot.speed, int(robot.heading), robot.health,
+                                          COLLISION_WALL if collision == crashbots.WALL else collision))
+        self.out.write(''.join(frame))
+
+class Replay(object):
+    '''
+    Frames by tick from a replay, data is a string or a mmap. Frames are
+    decoded as they are read.
+    '''
+    def __init__(self, data):
+        self.data = data
+        magic, version, robots, self.width, self.height = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a version %d crashbots replay' % VERSION)
+        offset = HEADER.size
+        self.names = []
+        for _ in xrange(robots):
+            length, = NAME_LENGTH.unpack_from(data, offset)
+            offset += NAME_LENGTH.size
+            self.names.append(data[offset:offset + length])
+            offset += length
+        self.start = offset
+        self.frame_size = FRAME_TICK.size + ROBOT_STATE.size * robots
+
+    @classmethod
+    def open(cls, filename):
+        '''A Replay of the file filename, read through mmap.'''
+        with open(filename, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        '''Number of complete frames, a replay still being written may end in part of one.'''
+        return (len(self.data) - self.start) // self.frame_size
+
+    def __getitem__(self, tick):
+        '''The robot states after tick as Properties, in robot id order.'''
+        if tick < 0:
+            tick += len(self)
+        if not 0 <= tick < len(self):
+            raise IndexError('No tick ' + str(tick))
+        offset = self.start + tick * self.frame_size + FRAME_TICK.size
+        res = []
+        for index in xrange(len(self.names)):
+            pos_x, pos_y, speed, heading, health, collision = ROBOT_STATE.unpack_from(
+                self.data, offset + index * ROBOT_STATE.size)
+            res.append(crashbots.Properties(id=index + 1, pos_x=pos_x, pos_y=pos_y, speed=speed, heading=heading,
+                                            health=health, collision=collision))
+        return res
+
+def main(argv):
+    replay = Replay.open(argv[0])
+    ticks = [int(argv[1])] if len(argv) > 1 else xrange(len(replay))
+    for tick in ticks:
+        for name, robot in zip(replay.names, replay[tick]):
+            print tick, name, robot
+
+if __name__ == '__main__':
+    if not sys.argv[1:]:
+        sys.stderr.write('Usage: %s <replay file> [<tick>]\n' % sys.argv[0])
+        sys.exit(1)
+    main(sys.argv[1:])
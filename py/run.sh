@@ -15,4 +15,4 @@ fi
 ./build.sh
 
 echo "Running Crashbots"
-python crashbots.py
+python crashbots.py "$@"
@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 
-import re
+import ast
 import sys
-import copy
+import gzip
+import struct
+import operator
+import hashlib
+import collections
+from itertools import compress
 
-## 256 words of memory (can be anything, string, number, object or int)
+## 256 words of memory (can be anything, string, number, object or int),
+## unless the Cpu is given another size
 MEMSIZE = 256
-## 4 general purpose registers
+## 4 general purpose registers, unless the Cpu is given another count
 REGISTERS = 4
 ## Denotes the end of program
 END_OF_PROGRAM = 'halt'
@@ -14,8 +20,82 @@ END_OF_PROGRAM = 'halt'
 CHANGE_ADDRESS = 'change_address'
 ## Signals label declaration
 DECLARE_LABEL = 'declare_label'
-## For parsing code lines
-SPACE = re.compile('\s+')
+
+## Operand kinds used in SIGNATURES: (v)alue, (t)arget, (a)ddress,
+## (c)omparison, (f)unction and (d)ebug value. A trailing + or * repeats
+## the last kind one or more, or zero or more, times.
+VALUE = 'v'
+TARGET = 't'
+ADDRESS = 'a'
+COMPARISON = 'c'
+FUNCTION = 'f'
+DEBUG_VALUE = 'd'
+## Operand signature of every supported instruction
+SIGNATURES = {
+    'copy': 'tv',
+    'compute': 'tfv+',
+    'test': 'vcv',
+    'jump': 'a',
+    'jumpif': 'a',
+    'call': 'a',
+    'callif': 'a',
+    'back': '',
+    'push': 'v',
+    'pop': 't',
+    'trace': '',
+    'traceoff': '',
+    'debug': 'd*',
+    'longdebug': 'd*',
+}
+## Operators supported by test
+COMPARISONS = {
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+    '!=': operator.ne,
+    '=': operator.eq,
+}
+## Most program images Cpu.images keeps, the least recently loaded go first
+IMAGES_MAX = 1024
+## Execution engines, see Cpu
+REFERENCE = 'reference'
+FAST = 'fast'
+ENGINES = (REFERENCE, FAST)
+## Instructions the fast engine runs inline, the rest call the Cpu method
+FAST_INSTRUCTIONS = ('copy', 'compute', 'test', 'jump', 'jumpif', 'call', 'callif', 'back', 'push', 'pop')
+## Instruction sequences the fast engine fuses into superinstructions, longest first
+FUSIONS = [
+    ('compute', 'test', 'jumpif'),
+    ('compute', 'test', 'callif'),
+    ('test', 'jumpif'),
+    ('test', 'callif'),
+    ('compute', 'test'),
+]
+## Longest fused sequence
+FUSE_MAX = max([len(fusion) for fusion in FUSIONS])
+## Python operators generated by the fast engine for test and compute
+FAST_OPERATORS = {'=': '=='}
+## Functions supported by compute, called with the first value and a list of the rest
+FUNCTIONS = {
+    '+': lambda first, rest: first + sum(rest),
+    '-': lambda first, rest: first - sum(rest),
+    '*': lambda first, rest: reduce(operator.mul, rest, first),
+    '/': lambda first, rest: reduce(operator.div, rest, first),
+}
+
+## Name of system calls in trace records, see Cpu.syscall
+SYSCALL = 'syscall'
+## Cycles charged per system call unless the call sets its own
+SYSCALL_COST = 5
+## Instructions by opcode number in trace records
+OPCODES = sorted(SIGNATURES) + [END_OF_PROGRAM, SYSCALL]
+OPCODE_NUMBERS = dict([(name, number) for number, name in enumerate(OPCODES)])
+## Trace record: tick, trace id, program counter, opcode number, test flag
+## and the registers, NaN for values that aren't numbers. Only the first
+## REGISTERS (4) registers are recorded, registers a Cpu with fewer doesn't
+## have are NaN
+TRACE_RECORD = struct.Struct('<IHIBB' + 'd' * REGISTERS)
 
 class ParseException(Exception):
     pass
@@ -30,7 +110,9 @@ class NoOutput(object):
 class Getable(object):
     '''Base class for special memory mapped values, read only
     using assembler. These type of values can't be created in
-    memory using assembler.'''
+    memory using assembler. Plain values in cells marked with
+    Cpu.protect are cheaper for values that the host updates.'''
+    __slots__ = ('value',)
     def __init__(self, value):
         self.value = value
     def get(self):
@@ -44,11 +126,660 @@ class Setable(Getable):
     '''Base class for special memory mapped values, read/write
     using assembler. These type of values can't be created in
     memory using assembler.'''
+    __slots__ = ()
     def set(self, value):
         self.value = value
     def __repr__(self):
         return 'Setable(' + repr(self.value) + ')'
 
+def tokenize(line):
+    '''
+    Splits a code line into words, quoted strings are kept whole with
+    their quotes.
+
+    >>> tokenize("  copy @msg  'it's  a  test'  ")
+    ['copy', '@msg', "'it's  a  test'"]
+    >>> tokenize("copy R0 'oops")
+    Traceback (most recent call last):
+    ParseException: Unterminated string 'oops
+    '''
+    if "'" not in line:
+        return line.split()
+    res = []
+    pos, end = 0, len(line)
+    while pos < end:
+        if line[pos].isspace():
+            pos += 1
+            continue
+        start = pos
+        if line[pos] == "'":
+            # A quoted string runs to a quote followed by space or the end
+            pos = line.find("'", pos + 1)
+            while pos != -1 and pos + 1 < end and not line[pos + 1].isspace():
+                pos = line.find("'", pos + 1)
+            if pos != -1:
+                pos += 1
+                res.append(line[start:pos])
+                continue
+            pos = start
+        while pos < end and not line[pos].isspace():
+            pos += 1
+        if line[start] == "'":
+            raise ParseException('Unterminated string ' + line[start:pos])
+        res.append(line[start:pos])
+    return res
+
+def parse_literal(text):
+    '''
+    The value of a =<value> line: a number, a quoted string or any other
+    Python literal. Nothing is evaluated.
+
+    >>> [parse_literal(text) for text in ['12', ' -3', '0.5', "'a  b'", '"it\\'s"', 'None', '(1, [2])']]
+    [12, -3, 0.5, 'a  b', "it's", None, (1, [2])]
+    >>> parse_literal('__import__("os")')
+    Traceback (most recent call last):
+    ParseException: Invalid value __import__("os")
+    '''
+    text = text.strip()
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    if len(text) >= 2 and text[0] == text[-1] == "'" and "'" not in text[1:-1] and '\\' not in text:
+        return text[1:-1]
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        raise ParseException('Invalid value ' + text)
+
+def operand_kinds(name, count):
+    '''The kinds of the count operands given to instruction name.'''
+    signature = SIGNATURES[name]
+    repeat = None
+    if signature and signature[-1] in '+*':
+        repeat = signature[-2]
+        signature = signature[:-2] if signature[-1] == '*' else signature[:-1]
+    if count < len(signature) or (repeat is None and count > len(signature)):
+        raise ParseException('Wrong number of arguments to ' + name)
+    return signature + (repeat or '') * (count - len(signature))
+
+class Instruction(object):
+    '''A decoded instruction. The handler is the unbound Cpu method and
+    args are the compiled operands, text keeps the source operands for
+    disassembly.'''
+    __slots__ = ('name', 'func', 'args', 'text', 'lineno')
+    def __init__(self, name, func, text, lineno=None):
+        self.name = name
+        self.func = func
+        self.args = None
+        self.text = text
+        self.lineno = lineno
+    def __repr__(self):
+        return 'Instruction(' + ' '.join([self.name] + self.text) + ')'
+
+class Unparsed(object):
+    '''A code line loaded lazily, see Cpu.load. It runs as Cpu.run_unparsed,
+    which decodes the line the first time it is executed. The decoded
+    instruction is kept so every Cpu sharing the line decodes it once.'''
+    __slots__ = ('line', 'lineno', 'func', 'args', 'decoded')
+    def __init__(self, line, lineno=None):
+        self.line = line
+        self.lineno = lineno
+        self.func = Cpu.run_unparsed
+        self.args = ()
+        self.decoded = None
+    def __repr__(self):
+        return 'Unparsed(' + self.line + ')'
+
+class Syscall(object):
+    '''A native routine in memory, see Cpu.syscall. It runs as
+    Cpu.run_syscall, name is its label.'''
+    __slots__ = ('name', 'handler', 'cost', 'func', 'args')
+    def __init__(self, name, handler, cost=SYSCALL_COST):
+        self.name = name
+        self.handler = handler
+        self.cost = cost
+        self.func = Cpu.run_syscall
+        self.args = (self,)
+    def __repr__(self):
+        return 'Syscall(' + self.name + ')'
+
+def open_source(filename):
+    '''Opens a program file for Cpu.load, gzip compressed if the name ends in .gz.'''
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename)
+
+def digest_lines(lines, digest):
+    '''
+    Yields lines without line endings, adding them to digest as if they
+    were joined by newlines.
+
+    >>> digest = hashlib.sha1()
+    >>> list(digest_lines(iter(['a\\n', 'b\\r\\n', 'c']), digest))
+    ['a', 'b', 'c']
+    >>> digest.hexdigest() == hashlib.sha1('a\\nb\\nc').hexdigest()
+    True
+    '''
+    separator = ''
+    for line in lines:
+        line = line.rstrip('\r\n')
+        digest.update(separator + line)
+        separator = '\n'
+        yield line
+
+class Operand(object):
+    '''A compiled instruction operand. Each kind of operand knows how to
+    read, write and locate itself so that running an instruction never
+    looks at the source text again. A plain Operand is invalid and raises
+    on any use, debug prints those as **text.'''
+    __slots__ = ('text',)
+    def __init__(self, text):
+        self.text = text
+    def get(self, cpu):
+        raise RuntimeException('Invalid value reference ' + self.text)
+    def set(self, cpu, value):
+        raise RuntimeException('Invalid target reference ' + self.text)
+    def address(self, cpu):
+        raise RuntimeException('Invalid address reference ' + self.text)
+    def target(self, cpu):
+        return self.address(cpu)
+    def __repr__(self):
+        return type(self).__name__ + '(' + repr(self.text) + ')'
+
+class Constant(Operand):
+    '''Number, string or label address value.'''
+    __slots__ = ('value',)
+    def __init__(self, text, value):
+        Operand.__init__(self, text)
+        self.value = value
+    def get(self, cpu):
+        return self.value
+
+class Register(Operand):
+    '''R<num> register.'''
+    __slots__ = ('index',)
+    def __init__(self, text, index):
+        Operand.__init__(self, text)
+        self.index = index
+    def get(self, cpu):
+        return cpu.registers[self.index]
+    def set(self, cpu, value):
+        cpu.registers[self.index] = value
+
+class Address(Operand):
+    '''Fixed memory address, @<num>.'''
+    __slots__ = ('addr',)
+    def __init__(self, text, addr):
+        Operand.__init__(self, text)
+        self.addr = addr
+    def get(self, cpu):
+        res = cpu.memory[self.addr]
+        if isinstance(res, Getable):
+            return res.get()
+        return res
+    def set(self, cpu, value):
+        if cpu.readonly[self.addr] or isinstance(cpu.memory[self.addr], Getable):
+            cpu.write(self.addr, value)
+        else:
+            cpu.memory[self.addr] = value
+    def address(self, cpu):
+        return self.addr
+    def target(self, cpu):
+        return self.addr
+
+class Label(Address):
+    '''Memory address resolved from a label at load time, @<label>.'''
+    __slots__ = ()
+
+class Indirect(Operand):
+    '''Memory address held in a register, @R<num>.'''
+    __slots__ = ('index',)
+    def __init__(self, text, index):
+        Operand.__init__(self, text)
+        self.index = index
+    def get(self, cpu):
+        return cpu.read(self.address(cpu))
+    def set(self, cpu, value):
+        cpu.write(self.address(cpu), value)
+    def address(self, cpu):
+        addr = cpu.registers[self.index]
+        if not isinstance(addr, (int, long)) or addr >= cpu.memsize or addr < 0:
+            raise RuntimeException('Address ' + self.text + ' out of bounds (' + repr(addr) + ')')
+        return addr
+    def target(self, cpu):
+        '''Branch target, looked up in the jump table of the program.'''
+        addr = cpu.jump_table.get(cpu.registers[self.index])
+        return self.address(cpu) if addr is None else addr
+
+class FastTranslator(object):
+    '''Translates an instruction, or a fused group of instructions, into
+    Python source for a specialized closure used by the fast engine. The
+    closure returns the next program counter, or None after it has updated
+    the Cpu itself. Factories are cached by source so each distinct
+    instruction is compiled once.'''
+    factories = {}
+
+    def __init__(self, instrs, pc, fusion=None, memsize=MEMSIZE):
+        self.lines = []
+        self.consts = []
+        self.temps = 0
+        self.fusion = fusion or {}
+        self.memsize = memsize
+        self.flag = 'cpu.test_flag'
+        self.start, self.end = pc, pc + len(instrs)
+        for i, instr in enumerate(instrs):
+            self.pc = pc + i
+            self.last = i == len(instrs) - 1
+            getattr(self, 'do_' + instr.name)(instr, 1)
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * (indent + 1) + line)
+
+    def temp(self):
+        self.temps += 1
+        return 'x%d' % self.temps
+
+    def next(self, indent):
+        if self.last:
+            self.emit(indent, 'return %d' % (self.pc + 1))
+
+    def address(self, op, indent):
+        if not isinstance(op, Indirect):
+            return str(op.addr)
+        var = self.temp()
+        self.emit(indent, '%s = regs[%d]' % (var, op.index))
+        self.emit(indent, 'if not isinstance(%s, (int, long)) or %s >= %d or %s < 0:' % (var, var, self.memsize, var))
+        self.emit(indent + 1, 'raise RuntimeException(%r + repr(%s) + %r)'
+                  % ('Address ' + op.text + ' out of bounds (', var, ')'))
+        return var
+
+    def read(self, op, indent):
+        if isinstance(op, Constant):
+            self.consts.append(op.value)
+            return 'k%d' % (len(self.consts) - 1)
+        if isinstance(op, Register):
+            return 'regs[%d]' % op.index
+        addr = self.address(op, indent)
+        var = self.temp()
+        self.emit(indent, '%s = mem[%s]' % (var, addr))
+        self.emit(indent, 'if isinstance(%s, Getable): %s = %s.get()' % (var, var, var))
+        return var
+
+    def write(self, op, value, indent):
+        if isinstance(op, Register):
+            self.emit(indent, 'regs[%d] = %s' % (op.index, value))
+            return
+        addr = self.address(op, indent)
+        self.emit(indent, 'if ro[%s] or isinstance(mem[%s], Getable): cpu.write(%s, %s)' % (addr, addr, addr, value))
+        self.emit(indent, 'else: mem[%s] = %s' % (addr, value))
+        # Drop the closures for the written address and any fused group covering it
+        if not self.fusion:
+            self.emit(indent, 'code[%s] = None' % addr)
+        elif isinstance(op, Indirect):
+            self.emit(indent, ' = '.join(['code[%s - %d]' % (addr, i) for i in xrange(FUSE_MAX)] + ['None']))
+        else:
+            starts = [start for start in xrange(op.addr - FUSE_MAX + 1, op.addr)
+                      if start + len(self.fusion.get(start, ())) > op.addr]
+            self.emit(indent, ' = '.join(['code[%d]' % start for start in starts + [op.addr]] + ['None']))
+        if self.last:
+            return
+        # A write into the rest of the group stops it, the loop is charged
+        # only for the instructions that ran
+        stop = 'cpu.cost[%d] = %d; return %d' % (self.start, self.pc + 1 - self.start, self.pc + 1)
+        if isinstance(op, Indirect):
+            self.emit(indent, 'if %d < %s < %d: %s' % (self.pc, addr, self.end, stop))
+        elif self.pc < op.addr < self.end:
+            self.emit(indent, stop)
+
+    def branch(self, op, indent):
+        if not isinstance(op, Indirect):
+            self.emit(indent, 'return %d' % op.addr)
+            return
+        var = self.temp()
+        self.emit(indent, '%s = cpu.jump_table.get(regs[%d])' % (var, op.index))
+        self.emit(indent, 'if %s is None:' % var)
+        self.emit(indent + 1, '%s = %s' % (var, self.address(op, indent + 1)))
+        self.emit(indent, 'return ' + var)
+
+    def do_copy(self, instr, indent):
+        value = self.read(instr.args[1], indent)
+        self.emit(indent, 'v = ' + value)
+        self.write(instr.args[0], 'v', indent)
+        self.next(indent)
+
+    def do_compute(self, instr, indent):
+        values = [self.read(op, indent) for op in instr.args[2:]]
+        func = FAST_OPERATORS.get(instr.text[1], instr.text[1])
+        if func in '+-':
+            expr = '%s %s (%s)' % (values[0], func, ' + '.join(['0'] + values[1:]))
+        else:
+            expr = (' ' + func + ' ').join(values)
+        self.emit(indent, 'v = ' + expr)
+        self.write(instr.args[0], 'v', indent)
+        self.next(indent)
+
+    def do_test(self, instr, indent):
+        left = self.read(instr.args[0], indent)
+        right = self.read(instr.args[2], indent)
+        op = FAST_OPERATORS.get(instr.text[1], instr.text[1])
+        if self.last:
+            self.emit(indent, 'cpu.test_flag = %s %s %s' % (left, op, right))
+        else:
+            self.emit(indent, 'flag = cpu.test_flag = %s %s %s' % (left, op, right))
+            self.flag = 'flag'
+        self.next(indent)
+
+    def do_jump(self, instr, indent):
+        self.branch(instr.args[0], indent)
+
+    def do_jumpif(self, instr, indent):
+        self.emit(indent, 'if %s:' % self.flag)
+        self.branch(instr.args[0], indent + 1)
+        self.next(indent)
+
+    def do_call(self, instr, indent):
+        self.emit(indent, 'stack.append(%d)' % self.pc)
+        self.branch(instr.args[0], indent)
+
+    def do_callif(self, instr, indent):
+        self.emit(indent, 'if %s:' % self.flag)
+        self.do_call(instr, indent + 1)
+        self.next(indent)
+
+    def do_back(self, instr, indent):
+        self.emit(indent, 'return int(stack.pop()) + 1')
+
+    def do_push(self, instr, indent):
+        self.emit(indent, 'stack.append(%s)' % self.read(instr.args[0], indent))
+        self.next(indent)
+
+    def do_pop(self, instr, indent):
+        self.emit(indent, 'v = stack.pop()')
+        self.write(instr.args[0], 'v', indent)
+        self.next(indent)
+
+    def source(self):
+        res = ['def make(cpu, regs, mem, ro, stack, code, consts):']
+        if self.consts:
+            res.append('    ' + ', '.join(['k%d' % i for i in xrange(len(self.consts))]) + ', = consts')
+        res.append('    def step():')
+        res.extend(['    ' + line for line in self.lines])
+        res.append('    return step')
+        return '\n'.join(res) + '\n'
+
+    def make(self, cpu, code):
+        source = self.source()
+        factory = FastTranslator.factories.get(source)
+        if factory is None:
+            namespace = {'Getable': Getable, 'RuntimeException': RuntimeException}
+            exec compile(source, '<fast engine>', 'exec') in namespace
+            factory = FastTranslator.factories[source] = namespace['make']
+        return factory(cpu, cpu.registers, cpu.memory, cpu.readonly, cpu.stack, code, self.consts)
+
+class SparseList(dict):
+    '''
+    A list of size cells kept as a dict of the cells set over base, a dict
+    of cells shared with other SparseLists and never changed through this
+    one. Cells in neither are default. Indexing, slices, len, iteration and
+    count work as for a list of the same size. As a dict it holds only the
+    cells set, so copying it or comparing what changed costs no more than
+    the cells written.
+
+    >>> image = {0: 'a', 2: 'c'}
+    >>> cells = SparseList(5, base=image)
+    >>> cells[1:4] = ['B', None, 'D']
+    >>> cells[2], cells[:], len(cells), cells.count(None)
+    (None, ['a', 'B', None, 'D', None], 5, 2)
+    >>> sorted(cells.items()), cells.cells()
+    ([(1, 'B'), (2, None), (3, 'D')], [(0, 'a'), (1, 'B'), (3, 'D')])
+    '''
+    __slots__ = ('size', 'base', 'default')
+    def __init__(self, size, base=None, default=None):
+        dict.__init__(self)
+        self.size = size
+        self.base = {} if base is None else base
+        self.default = default
+
+    def __missing__(self, addr):
+        return self.base.get(addr, self.default)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for addr in xrange(self.size):
+            yield self[addr]
+
+    def __getslice__(self, start, stop):
+        return [self[addr] for addr in xrange(start, min(stop, self.size))]
+
+    def __setslice__(self, start, stop, values):
+        '''Sets the cells from start to values, the size never changes.'''
+        self.update(zip(xrange(start, min(stop, self.size)), values))
+
+    def cells(self):
+        '''(address, value) of every cell that is not None, by address.'''
+        res = dict(self.base)
+        res.update(self)
+        return sorted([(addr, value) for addr, value in res.iteritems() if value is not None])
+
+    def count(self, value):
+        cells = self.cells()
+        res = len([cell for _, cell in cells if cell == value])
+        return res + self.size - len(cells) if value is None else res
+
+    def dense(self):
+        '''The cells as a list, up to the last one that is not None.'''
+        cells = self.cells()
+        return self[:cells[-1][0] + 1] if cells else []
+
+class ProgramImage(object):
+    '''A parsed, compiled and validated program. Images are shared by
+    every Cpu loading the same source and must not be modified. Sparse
+    memory is kept as a dict of the cells set.'''
+    __slots__ = ('memory', 'labels', 'jump_table', 'fusion')
+    def __init__(self, memory, labels, jump_table):
+        self.memory = dict(memory.cells()) if isinstance(memory, SparseList) else tuple(memory)
+        self.labels = labels
+        self.jump_table = jump_table
+        self.fusion = None
+
+class CpuState(object):
+    '''The state of a Cpu that running a program changes, see Cpu.snapshot.
+    States can be restored any number of times and must not be modified.
+    Of sparse memory only the cells set over the program image are kept.'''
+    __slots__ = ('memory', 'readonly', 'registers', 'stack', 'program_counter',
+                 'test_flag', 'trace_flag', 'halted_flag', 'stall')
+    def __init__(self, cpu):
+        if isinstance(cpu.memory, SparseList):
+            self.memory = dict(cpu.memory)
+            self.readonly = dict(cpu.readonly)
+        else:
+            self.memory = tuple(cpu.memory)
+            self.readonly = str(cpu.readonly)
+        self.registers = tuple(cpu.registers)
+        self.stack = tuple(cpu.stack)
+        self.program_counter = cpu.program_counter
+        self.test_flag = cpu.test_flag
+        self.trace_flag = cpu.trace_flag
+        self.halted_flag = cpu.halted_flag
+        self.stall = cpu.stall
+
+class TraceBuffer(object):
+    '''
+    Collects fixed size TRACE_RECORD records of the instructions traced by
+    every Cpu with this as tracer. Records are written to out, a binary
+    file, or kept in a ring buffer of the last size records when out is
+    None. The host sets tick. Use traceview.py to read and disassemble
+    records.
+
+    >>> cpu = Cpu('traced')
+    >>> cpu.load(['copy R0 1', 'trace', 'compute R0 + R0 1', 'traceoff', 'halt'])
+    >>> cpu.tracer = TraceBuffer(size=2)
+    >>> cpu.trace_id, cpu.tracer.tick = 7, 3
+    >>> cpu.run()
+    >>> [TRACE_RECORD.unpack_from(record) for record in cpu.tracer.records()]
+    [(3, 7, 2, 3, 0, 1.0, nan, nan, nan), (3, 7, 3, 13, 0, 2.0, nan, nan, nan)]
+    >>> cpu.tracer.count
+    2
+
+    Program counters take the whole memsize, registers past the first
+    REGISTERS are left out:
+
+    >>> cpu = Cpu('traced high', memsize=70000, registers=6)
+    >>> cpu.load(['jump far', '@66000', 'far:', 'copy R5 5', 'trace', 'copy R0 1', 'halt'])
+    >>> cpu.tracer = TraceBuffer(size=1)
+    >>> cpu.run()
+    >>> [TRACE_RECORD.unpack_from(record) for record in cpu.tracer.records()]
+    [(0, 0, 66003, 14, 0, 1.0, nan, nan, nan)]
+
+    Running data is the same error traced or not:
+
+    >>> cpu = Cpu('traced data')
+    >>> cpu.load(['trace', 'copy R0 data', 'jump R0', 'data:', '=5'])
+    >>> cpu.tracer = TraceBuffer()
+    >>> cpu.run_cycles(4)
+    Traceback (most recent call last):
+    RuntimeException: No instruction at 3
+    '''
+    def __init__(self, out=None, size=65536):
+        self.out = out
+        self.size = size
+        self.buffer = bytearray(TRACE_RECORD.size * size) if out is None else None
+        self.tick = 0
+        self.count = 0
+
+    def record(self, cpu, pc, instr):
+        if isinstance(instr, Instruction):
+            opcode = OPCODE_NUMBERS[instr.name]
+        elif isinstance(instr, Syscall):
+            opcode = OPCODE_NUMBERS[SYSCALL]
+        elif instr is END_OF_PROGRAM:
+            opcode = OPCODE_NUMBERS[END_OF_PROGRAM]
+        else:
+            raise RuntimeException('No instruction at ' + str(pc))
+        values = cpu.registers
+        try:
+            self.write(cpu, pc, opcode, values)
+        except struct.error:
+            values = [value if type(value) in (int, long, float) else float('nan') for value in values]
+            values = (values + [float('nan')] * REGISTERS)[:REGISTERS]
+            self.write(cpu, pc, opcode, values)
+        self.count += 1
+
+    def write(self, cpu, pc, opcode, values):
+        if self.buffer is None:
+            self.out.write(TRACE_RECORD.pack(self.tick, cpu.trace_id, pc, opcode, cpu.test_flag, *values))
+        else:
+            TRACE_RECORD.pack_into(self.buffer, self.count % self.size * TRACE_RECORD.size,
+                                   self.tick, cpu.trace_id, pc, opcode, cpu.test_flag, *values)
+
+    def records(self):
+        '''The records in the ring buffer, oldest first.'''
+        size = TRACE_RECORD.size
+        start = self.count % self.size if self.count > self.size else 0
+        for index in xrange(min(self.count, self.size)):
+            offset = (start + index) % self.size * size
+            yield str(self.buffer[offset:offset + size])
+
+    def dump(self, out):
+        '''Writes the records in the ring buffer to out, a binary file.'''
+        for record in self.records():
+            out.write(record)
+
+class Profile(object):
+    '''
+    Counts collected by a Cpu while its profile is set: instructions run
+    per address and per opcode, taken calls per (call site, target),
+    cycles per call stack and the deepest stack seen. Call stacks follow
+    call and back, each frame is a call target address.
+
+    >>> cpu = Cpu('profiled')
+    >>> cpu.load(['copy R0 3', 'loop:', 'call work', 'compute R0 - R0 1', 'test R0 > 0',
+    ...           'jumpif loop', 'halt', 'work:', 'push R0', 'pop R1', 'back'])
+    >>> cpu.profile = Profile()
+    >>> cpu.run()
+    >>> print cpu.profile.annotate(cpu)
+              @0
+            1     copy R0 3
+              loop:
+            3     call work
+            3     compute R0 - R0 1
+            3     test R0 > 0
+            3     jumpif loop
+            1 halt
+              work:
+            3     push R0
+            3     pop R1
+            3     back
+    >>> print cpu.profile.collapsed(cpu)
+    profiled 14
+    profiled;work 9
+    >>> print cpu.profile
+    opcode   count
+    back         3
+    call         3
+    compute      3
+    copy         1
+    halt         1
+    jumpif       3
+    pop          3
+    push         3
+    test         3
+    call site target count
+    1         6          3
+    stack max 2
+    '''
+    def __init__(self):
+        self.addresses = {}
+        self.opcodes = {}
+        self.calls = {}
+        self.stacks = {}
+        self.stack_max = 0
+        self.frames = ()
+
+    def record(self, pc, instr):
+        '''Counts instr at pc about to run.'''
+        self.addresses[pc] = self.addresses.get(pc, 0) + 1
+        name = instr.name if isinstance(instr, (Instruction, Syscall)) else str(instr)
+        self.opcodes[name] = self.opcodes.get(name, 0) + 1
+        self.stacks[self.frames] = self.stacks.get(self.frames, 0) + 1
+
+    def call(self, pc, target):
+        self.calls[pc, target] = self.calls.get((pc, target), 0) + 1
+        self.frames += (target,)
+
+    def back(self):
+        self.frames = self.frames[:-1]
+
+    def annotate(self, cpu):
+        '''The disassembly of cpu with the times each instruction ran.'''
+        return cpu.disassemble(cpu.memory, counts=self.addresses)
+
+    def collapsed(self, cpu):
+        '''Cycles per call stack as collapsed stacks for flame graph tools,
+        one "cpu;frame;frame cycles" line per stack.'''
+        names = dict([(addr, label) for label, addr in cpu.labels.iteritems()])
+        lines = []
+        for frames, count in self.stacks.iteritems():
+            stack = [cpu.name] + [names.get(frame, '@' + str(frame)) for frame in frames]
+            lines.append(';'.join(stack).replace(' ', '_') + ' ' + str(count))
+        return '\n'.join(sorted(lines))
+
+    def __str__(self):
+        lines = ['opcode   count']
+        lines.extend(['%-8s %5d' % item for item in sorted(self.opcodes.iteritems())])
+        lines.append('call site target count')
+        lines.extend(['%-9d %-6d %5d' % (pc, target, count)
+                      for (pc, target), count in sorted(self.calls.iteritems())])
+        lines.append('stack max ' + str(self.stack_max))
+        return '\n'.join(lines)
+
 class Cpu(object):
     '''
     A simulated CPU, supporting a simple asm syntax:
@@ -103,7 +834,7 @@ class Cpu(object):
         Pops a value from the stack into a target
 
     trace
-        Turns on program trace
+        Turns on program trace, see TraceBuffer
 
     traceoff
         Turns off program trace
@@ -115,17 +846,103 @@ class Cpu(object):
         Outputs a lot of debug information and listed values
 
 '''
-    def __init__(self, name):
+    ## Program images by source hash, least recently loaded first, see load
+    images = collections.OrderedDict()
+    images_max = IMAGES_MAX
+
+    def __init__(self, name, engine=REFERENCE, memsize=MEMSIZE, registers=REGISTERS, sparse=False):
+        '''
+        Creates a Cpu. engine selects how instructions are executed, the
+        REFERENCE interpreter in cpu_cycle or the FAST engine that translates
+        memory into specialized closures on first execution. Both give the
+        same results. memsize is the number of memory words and registers
+        the number of registers.
+
+        >>> program = """
+        ... copy R0 10
+        ... copy R1 0
+        ... loop:
+        ... compute R1 + R1 R0 @half
+        ... compute R0 - R0 1
+        ... test R0 > 0
+        ... jumpif loop
+        ... push R1
+        ... call sub
+        ... pop @half
+        ... halt
+        ... sub:
+        ... compute R1 / R1 2
+        ... back
+        ... half:
+        ... =0.5
+        ... """.split('\\n')
+        >>> cpus = [Cpu('ref'), Cpu('fast', engine=FAST)]
+        >>> for cpu in cpus:
+        ...     cpu.load(program)
+        ...     cpu.run()
+        >>> [(cpu.registers, cpu.memory[cpu.labels['half']], cpu.program_counter) for cpu in cpus]
+        [([0, 30.0, None, None], 60.0, 9), ([0, 30.0, None, None], 60.0, 9)]
+
+        With sparse, memory is a SparseList holding only the cells the Cpu
+        set over the program image it shares with every Cpu loading the
+        same program, so large and mostly empty memories cost little more
+        than the program.
+
+        >>> program = ['copy R7 @data', 'copy @R7 R7', 'halt', '@60000', 'data:', '=60001']
+        >>> cpus = [Cpu('big', memsize=65536, registers=8), Cpu('big sparse', memsize=65536, registers=8, sparse=True)]
+        >>> for cpu in cpus:
+        ...     cpu.load(program)
+        ...     cpu.run()
+        >>> [(cpu.memory[60001], len(cpu.memory), len(cpu.registers)) for cpu in cpus]
+        [(60001, 65536, 8), (60001, 65536, 8)]
+        >>> dict(cpus[1].memory)
+        {60001: 60001}
+        >>> Cpu('small', memsize=16).load(program)
+        Traceback (most recent call last):
+        ParseException: Out of memory parsing program
+
+        Engine names built at runtime select the same engine:
+
+        >>> Cpu('runtime engine', engine=''.join(['fa', 'st'])).engine is FAST
+        True
+        '''
+        if engine not in ENGINES:
+            raise ValueError('Unsupported engine ' + repr(engine))
         self.name = name
-        self.memory = [None for _ in xrange(MEMSIZE)]
-        self.registers = [None for _ in xrange(REGISTERS)]
+        # The engine constant itself, as the run loops compare with is
+        self.engine = ENGINES[ENGINES.index(engine)]
+        self.memsize = memsize
+        self.sparse = sparse
+        if sparse:
+            self.memory = SparseList(memsize)
+            # Non zero for cells programs can't write, see protect
+            self.readonly = SparseList(memsize, default=0)
+        else:
+            self.memory = [None for _ in xrange(memsize)]
+            self.readonly = bytearray(memsize)
+        self.registers = [None for _ in xrange(registers)]
         self.program_counter = 0
         self.stack = []
         self.labels = {}
+        # Valid branch targets, every instruction address to itself, so
+        # branches through registers need a single lookup
+        self.jump_table = {}
         self.test_flag = False
         self.trace_flag = False
         self.halted_flag = False
+        # Cycles a system call still has to be charged, see syscall
+        self.stall = 0
         self.out = sys.stdout
+        self.breakpoints = set()
+        # Profile collecting counts, the Cpu runs slower while set
+        self.profile = None
+        # TraceBuffer taking trace records instead of out, trace_id tells
+        # Cpus apart in the records
+        self.tracer = None
+        self.trace_id = 0
+        self.code = None
+        self.fusion = {}
+        self.cost = None
 
     @classmethod
     def ez_run(cls, program_string):
@@ -140,9 +957,15 @@ class Cpu(object):
         res.run()
         return res
 
-    def load(self, lines, start_address=0):
+    def load(self, lines, start_address=0, fuse=False, lazy=False):
         """
-        Loads a program from a line-by-line iterable.
+        Loads a program from a line-by-line iterable, a list, a file object or
+        a generator. Lines that aren't lists or tuples are parsed as they are
+        read and never held together. With fuse the program is also scanned
+        for sequences the fast engine can run as superinstructions, see fuse.
+        With lazy, code lines are kept as Unparsed and only decoded when they
+        first run, so unreachable code is never parsed and its errors are
+        only reported if it runs.
 
         >>> cpu = Cpu('load test 1')
         >>> cpu.load(['halt'])
@@ -179,13 +1002,108 @@ class Cpu(object):
         ... pastsub:
         ... longdebug
         ... halt'''.split('\\n'))
+
+        Programs loaded into a fresh Cpu are parsed, compiled and validated
+        once, then the instructions and labels are shared with every other
+        Cpu loading the same source. Each Cpu gets its own copy of memory.
+
+        >>> cpus = [Cpu('shared 1'), Cpu('shared 2')]
+        >>> for cpu in cpus:
+        ...     cpu.load(['copy @var 1', 'halt', 'var:', '=0'])
+        >>> cpus[0].memory[0] is cpus[1].memory[0], cpus[0].labels is cpus[1].labels
+        (True, True)
+        >>> cpus[0].run()
+        >>> cpus[0].memory[2], cpus[1].memory[2]
+        (1, 0)
+
+        Only the images of the images_max programs loaded last are kept:
+
+        >>> images_max, Cpu.images_max = Cpu.images_max, 2
+        >>> for value in xrange(3):
+        ...     Cpu('cached %d' % value).load(['copy R0 %d' % value, 'halt'])
+        >>> len(Cpu.images)
+        2
+        >>> Cpu.images_max = images_max
+
+        Lazily loaded lines are decoded as they run:
+
+        >>> cpu = Cpu('lazy test')
+        >>> cpu.load(('copy R%d %d' % (index, index) for index in xrange(3)), lazy=True)
+        >>> cpu.memory[:4]
+        [Unparsed(copy R0 0), Unparsed(copy R1 1), Unparsed(copy R2 2), None]
+        >>> cpu.run_cycles(2)
+        2
+        >>> cpu.memory[:3]
+        [Instruction(copy R0 0), Instruction(copy R1 1), Unparsed(copy R2 2)]
         """
+        image = None
+        if self.labels or self.memory.count(None) != len(self.memory):
+            self.labels = dict(self.labels)
+            self.parse_lines(lines, start_address, lazy)
+        else:
+            digest = hashlib.sha1()
+            if isinstance(lines, (list, tuple)):
+                digest.update('\n'.join(lines))
+                image = Cpu.images.pop(self.image_key(start_address, lazy, digest), None)
+            if image is None:
+                if not isinstance(lines, (list, tuple)):
+                    lines = digest_lines(lines, digest)
+                self.parse_lines(lines, start_address, lazy)
+                image = (Cpu.images.pop(self.image_key(start_address, lazy, digest), None)
+                         or ProgramImage(self.memory, self.labels, self.jump_table))
+            Cpu.images[self.image_key(start_address, lazy, digest)] = image
+            while len(Cpu.images) > Cpu.images_max:
+                Cpu.images.popitem(last=False)
+            self.memory = SparseList(self.memsize, base=image.memory) if self.sparse else list(image.memory)
+            self.labels = image.labels
+            self.jump_table = image.jump_table
+        if fuse:
+            self.fuse(image and image.fusion)
+            if image:
+                image.fusion = self.fusion
+
+    def load_file(self, filename, start_address=0, fuse=False, lazy=False):
+        '''
+        Loads the program in filename, gzip compressed if it ends in .gz,
+        streaming it line by line. See load.
+
+        >>> import os, shutil, tempfile
+        >>> directory = tempfile.mkdtemp()
+        >>> filename = os.path.join(directory, 'program.gz')
+        >>> with gzip.open(filename, 'wb') as f:
+        ...     f.writelines(['copy R0 7\\n', 'halt\\n'])
+        >>> cpu = Cpu('file test')
+        >>> cpu.load_file(filename)
+        >>> cpu.run()
+        >>> cpu.registers[0]
+        7
+        >>> shutil.rmtree(directory)
+        '''
+        with open_source(filename) as f:
+            self.load(f, start_address, fuse, lazy)
+
+    def image_key(self, start_address, lazy, digest):
+        '''Key in images for a program loaded with the source digest.'''
+        return (type(self), start_address, self.memsize, len(self.registers), self.sparse, lazy, digest.hexdigest())
+
+    def parse_lines(self, lines, start_address, lazy=False):
+        '''
+        Parses, compiles and validates lines into memory. Parsing goes on
+        after a bad line so every one is written to stderr with its line
+        number, then the first error is raised.
+
+        >>> cpu = Cpu('errors test')
+        >>> cpu.load(['copy R0 1', 'jomp end', 'end:', 'end:', 'halt'])
+        Traceback (most recent call last):
+        ParseException: Unsupported command jomp
+        '''
         addr = start_address
         lineno = 0
-        try:
-            for line in lines:
-                lineno += 1
-                parsed = self.parse(line)
+        errors = []
+        for line in lines:
+            lineno += 1
+            try:
+                parsed = self.parse(line, lineno, lazy)
                 if parsed is None:
                     continue
                 if isinstance(parsed, tuple):
@@ -197,206 +1115,738 @@ class Cpu(object):
                             raise ParseException('Redeclaration of ' + parsed[1])
                         self.labels[parsed[1]] = addr
                         continue
-                if addr >= MEMSIZE:
+                if addr >= self.memsize:
                     raise ParseException('Out of memory parsing program')
                 if self.memory[addr] is not None:
                     raise ParseException('Memory not None at ' + str(addr))
                 self.memory[addr] = parsed
                 addr += 1
-        except ParseException as e:
-            sys.stderr.write('%s: ERROR: %s\n' % (lineno, line))
-            sys.stderr.write('%s: ERROR: %s\n' % (lineno, e))
-            raise e
+            except ParseException as e:
+                sys.stderr.write('%s: ERROR: %s\n' % (lineno, line.rstrip('\r\n')))
+                sys.stderr.write('%s: ERROR: %s\n' % (lineno, e))
+                errors.append(e)
+                if addr >= self.memsize:
+                    break
+        if errors:
+            raise errors[0]
+        self.compile()
         self.program_validate()
+        self.jump_table = dict([(cell, cell) for cell, instr in self.cells()
+                                if instr is END_OF_PROGRAM or isinstance(instr, (Instruction, Unparsed))])
+
+    def fuse(self, fusion=None):
+        '''
+        Peephole pass marking the start of every FUSIONS sequence in memory,
+        unless the fusion table is given.
+        The fast engine runs each marked sequence as a single closure which
+        still counts one cycle per instruction, when fewer cycles than that
+        are left the instructions run one at a time. Jumps into the middle
+        of a sequence run the instructions from there as usual.
+
+        >>> program = [
+        ...     'copy R2 48',
+        ...     'look:',
+        ...     'compute R2 - R2 1',
+        ...     'test R2 >= 0',
+        ...     'jumpif look',
+        ...     'halt']
+        >>> ref, fast = Cpu('ref'), Cpu('fast', engine=FAST)
+        >>> ref.load(program)
+        >>> fast.load(program, fuse=True)
+        >>> sorted(fast.fusion.items())
+        [(1, ('compute', 'test', 'jumpif')), (2, ('test', 'jumpif'))]
+        >>> [ref.run_cycles(10) for _ in xrange(16)] == [fast.run_cycles(10) for _ in xrange(16)]
+        True
+        >>> ref.registers == fast.registers, fast.halted_flag
+        (True, True)
+
+        Breakpoints inside a sequence stop it there as on the reference engine:
+
+        >>> program = ['copy R0 0', 'loop:', 'compute R0 + R0 1', 'test R0 < 5', 'jumpif loop', 'halt']
+        >>> ref, fast = Cpu('ref'), Cpu('fast', engine=FAST)
+        >>> ref.load(program)
+        >>> fast.load(program, fuse=True)
+        >>> runs = []
+        >>> for cpu in ref, fast:
+        ...     cpu.breakpoints.update([2, 4])
+        ...     runs.append([(cpu.run_cycles(100), cpu.program_counter) for _ in xrange(7)])
+        >>> runs[0] == runs[1], runs[0]
+        (True, [(2, 2), (3, 2), (3, 2), (3, 2), (3, 2), (2, 4), (1, 4)])
+
+        A sequence that writes over its own instructions stops after the write:
+
+        >>> program = ['copy R2 2', 'compute @R2 + 0 7', 'test R2 = 2', 'jumpif done', 'halt',
+        ...            'done:', 'copy R0 99', 'halt']
+        >>> errors = []
+        >>> for cpu, fuse in (Cpu('ref'), False), (Cpu('fast', engine=FAST), False), (Cpu('fused', engine=FAST), True):
+        ...     cpu.load(program, fuse=fuse)
+        ...     try:
+        ...         cpu.run_cycles(100)
+        ...     except RuntimeException as e:
+        ...         errors.append((str(e), cpu.program_counter, cpu.registers[0]))
+        >>> errors
+        [('No instruction at 2', 2, None), ('No instruction at 2', 2, None), ('No instruction at 2', 2, None)]
+        '''
+        self.cost = SparseList(self.memsize, default=1) if self.sparse else [1] * self.memsize
+        self.code = None
+        if fusion is not None:
+            self.fusion = fusion
+            return
+        names = dict([(addr, instr.name) for addr, instr in self.cells() if isinstance(instr, Instruction)])
+        self.fusion = {}
+        for addr in sorted(names):
+            for fusion in FUSIONS:
+                if tuple([names.get(addr + i) for i in xrange(len(fusion))]) == fusion:
+                    self.fusion[addr] = fusion
+                    break
+
+    def compile(self):
+        '''
+        Compiles the operands of every instruction in memory that has not
+        been compiled yet. Runs once all labels are known.
+
+        >>> cpu = Cpu('compile test')
+        >>> cpu.load(['copy @var R1', 'test R0 < 7', 'call sub', 'var:', '=0', 'sub:', 'back'])
+        >>> cpu.memory[0].args
+        (Label('@var'), Register('R1'))
+        >>> cpu.memory[2].args
+        (Label('sub'),)
+        >>> cpu.load(['@10', 'jump nowhere'])
+        Traceback (most recent call last):
+        ParseException: Invalid address reference nowhere
+        '''
+        for _, instr in self.cells():
+            if isinstance(instr, Instruction) and instr.args is None:
+                try:
+                    instr.args = self.compile_args(instr.name, instr.text)
+                except ParseException as e:
+                    sys.stderr.write('%s: ERROR: %s\n' % (instr.lineno, instr))
+                    sys.stderr.write('%s: ERROR: %s\n' % (instr.lineno, e))
+                    raise e
+
+    def compile_args(self, name, args):
+        '''Compiles the source operands of instruction name into a tuple of
+        operands, following SIGNATURES.'''
+        kinds = operand_kinds(name, len(args))
+        return tuple([self.compile_operand(arg, kind) for arg, kind in zip(args, kinds)])
+
+    def compile_operand(self, text, kind=VALUE):
+        '''
+        Compiles a single operand of the given kind.
+
+        >>> cpu = Cpu('operand test')
+        >>> cpu.labels['here'] = 12
+        >>> cpu.compile_operand("'a b'"), cpu.compile_operand('1.5'), cpu.compile_operand('here')
+        (Constant("'a b'"), Constant('1.5'), Constant('here'))
+        >>> cpu.compile_operand('@here'), cpu.compile_operand('@12'), cpu.compile_operand('@R3')
+        (Label('@here'), Address('@12'), Indirect('@R3'))
+        >>> cpu.compile_operand('here', ADDRESS).addr
+        12
+        >>> cpu.compile_operand('R9')
+        Traceback (most recent call last):
+        ParseException: Invalid register R9
+        '''
+        if kind is COMPARISON:
+            if text not in COMPARISONS:
+                raise ParseException('Unsupported op ' + text)
+            return COMPARISONS[text]
+        if kind is FUNCTION:
+            if text not in FUNCTIONS:
+                raise ParseException('Unsupported func ' + text)
+            return FUNCTIONS[text]
+        if kind is DEBUG_VALUE:
+            try:
+                return self.compile_operand(text)
+            except ParseException:
+                return Operand(text)
+        if kind is ADDRESS:
+            return self.compile_address(text[1:] if text[:1] == '@' else text)
+        if kind is TARGET and text[:1] not in ('R', '@'):
+            raise ParseException('<target> must be either (R)egister or (@)address: ' + text)
+        if not text:
+            return Constant(text, None)
+        if text[0] == '@':
+            return self.compile_address(text[1:], text)
+        register = self.register_index(text)
+        if register is not None:
+            return Register(text, register)
+        if kind is TARGET:
+            raise ParseException('Invalid target reference ' + text)
+        if len(text) >= 2 and text[0] == "'" and text[-1] == "'":
+            return Constant(text, text[1:-1])
+        try:
+            return Constant(text, int(text))
+        except ValueError:
+            pass
+        try:
+            return Constant(text, float(text))
+        except ValueError:
+            pass
+        if text in self.labels:
+            return Constant(text, self.labels[text])
+        raise ParseException('Invalid value reference ' + text)
+
+    def compile_address(self, address, text=None):
+        '''Compiles a memory address, a plain integer, a register or a label.'''
+        text = text or address
+        register = self.register_index(address)
+        if register is not None:
+            return Indirect(text, register)
+        try:
+            res = Address(text, int(address))
+        except ValueError:
+            if address not in self.labels:
+                raise ParseException('Invalid address reference ' + address)
+            res = Label(text, self.labels[address])
+        if res.addr >= self.memsize or res.addr < 0:
+            raise ParseException('Address ' + text + ' out of bounds (' + str(res.addr) + ')')
+        return res
+
+    def register_index(self, text):
+        '''Index of register R<num>, or None if text is not a register.'''
+        if text[:1] != 'R' or not text[1:].isdigit():
+            return None
+        index = int(text[1:])
+        if index >= len(self.registers):
+            raise ParseException('Invalid register ' + text)
+        return index
 
     def program_validate(self):
         '''
-        Test the loaded instructions by running them all.
-        Memory, stack, flags and registers are restored after
-        '''
-        self.out = NoOutput()
-        backupmem, self.memory = self.memory, copy.copy(self.memory)
-        backupreg, self.registers = self.registers, copy.copy(self.registers)
-        backupstack, self.stack = self.stack, copy.copy(self.stack)
-        backupflags = self.test_flag, self.trace_flag, self.halted_flag
-        backuppc = self.program_counter
-        for mem in self.memory:
-            if isinstance(mem, tuple):
-                if isinstance(mem[0], type(self.load)):
-                    if mem[0] is self.pop:
-                        self.stack.append(0)
-                    mem[0](*(mem[1]))
-                    if mem[0] is self.push:
-                        self.stack.pop()
-        self.memory = backupmem
-        self.registers = backupreg
-        self.stack = backupstack
-        self.test_flag, self.trace_flag, self.halted_flag = backupflags
-        self.program_counter = backuppc
-        self.out = sys.stdout
-        
-    def parse(self, line):
+        Statically verifies the loaded instructions without running them.
+        Operand kinds, labels, registers and address bounds are checked when
+        operands are compiled. This checks that fixed targets are not read
+        only, that jumps and calls to fixed addresses land on instructions and
+        that compute on constants works. Every problem is written to stderr
+        with its line number and the first one is raised.
+
+        >>> cpu = Cpu('validate test')
+        >>> cpu.memory[9] = Getable(1)
+        >>> cpu.load(['copy @9 1', 'jump 7', 'compute R0 / 1 0'])
+        Traceback (most recent call last):
+        ParseException: Target is read only @9
+
+        Register operands are not known until the program runs:
+
+        >>> cpu = Cpu('validate test')
+        >>> cpu.load(['copy R3 data', 'test @R3 = 3', 'compute R0 + R0 1', 'halt', 'data:', '=3'])
+        '''
+        errors = []
+        for _, instr in self.cells():
+            if isinstance(instr, Instruction):
+                errors.extend([(instr, error) for error in self.verify(instr)])
+        for instr, error in errors:
+            sys.stderr.write('%s: ERROR: %s\n' % (instr.lineno, instr))
+            sys.stderr.write('%s: ERROR: %s\n' % (instr.lineno, error))
+        if errors:
+            raise ParseException(errors[0][1])
+
+    def cells(self):
+        '''(address, value) of every memory cell that is not None, by address.'''
+        if isinstance(self.memory, SparseList):
+            return self.memory.cells()
+        return [(addr, value) for addr, value in enumerate(self.memory) if value is not None]
+
+    def verify(self, instr):
+        '''Returns the problems found in a compiled instruction.'''
+        res = []
+        for op, kind in zip(instr.args, operand_kinds(instr.name, len(instr.args))):
+            if not isinstance(op, Address):
+                continue
+            target = self.memory[op.addr]
+            if kind is TARGET and (self.readonly[op.addr] or isinstance(target, Getable) and not isinstance(target, Setable)):
+                res.append('Target is read only ' + op.text)
+            if kind is ADDRESS and target is not END_OF_PROGRAM and not isinstance(target, (Instruction, Unparsed, Syscall)):
+                res.append('No instruction at ' + op.text)
+        if instr.name == 'compute' and all([isinstance(op, Constant) for op in instr.args[2:]]):
+            values = [op.value for op in instr.args[2:]]
+            try:
+                instr.args[1](values[0], values[1:])
+            except Exception as e:
+                res.append('Invalid computation ' + ' '.join(instr.text[1:]) + ': ' + str(e))
+        return res
+
+    def parse(self, line, lineno=None, lazy=False):
         line = line.strip()
         if not line or line[0] == '#':
             return None
         if line[0] == '@':
             return (CHANGE_ADDRESS, int(line[1:]))
         elif line[0] == '=':
-            return eval(line[1:])
+            return parse_literal(line[1:])
         elif line[-1] == ':':
             return (DECLARE_LABEL, line[:-1])
+        if lazy:
+            return END_OF_PROGRAM if line == 'halt' else Unparsed(line, lineno)
 
-        cols = SPACE.split(line)
-        i = len(cols) - 1
-        while i >= 0:
-            # Put strings back together again
-            # TODO: Fix case where strings have multiple spaces in them
-            if cols[i][-1] == "'":
-                j = i
-                while cols[i][0] != "'":
-                    i -= 1
-                    if i < 0:
-                        raise ParseException('Unstarted apostrophe')
-                cols[i] = ' '.join(cols[i:j+1])
-                del cols[i+1:j+1]
-            i -= 1
-        if not cols[0]:
-            cols = cols[1:]
+        cols = tokenize(line)
         cmd = cols[0]
         args = cols[1:]
         if cmd == 'halt':
             return END_OF_PROGRAM
-        try:
-            res = (getattr(self, cmd), args)
-            if cmd in ['compute', 'copy']:
-                if args[0][0] not in 'R@':
-                    raise ParseException('<target> must be either (R)egister or (@)address: ' + line)
-            return res
-        except AttributeError:
+        if cmd not in SIGNATURES:
             raise ParseException('Unsupported command ' + cmd)
+        return Instruction(cmd, getattr(type(self), cmd), args, lineno)
+
+    def decode(self, pc):
+        '''
+        Parses, compiles and verifies the Unparsed line at pc and puts the
+        instruction in memory. Errors are written to stderr with the line
+        number and raised.
+
+        >>> cpu = Cpu('decode test')
+        >>> cpu.load(['copy R0 1', 'jump end', 'bogus', 'end:', 'halt'], lazy=True)
+        >>> cpu.run()
+        >>> cpu.registers[0], cpu.memory[2]
+        (1, Unparsed(bogus))
+        >>> cpu.decode(2)
+        Traceback (most recent call last):
+        ParseException: Unsupported command bogus
+        '''
+        unparsed = self.memory[pc]
+        if unparsed.decoded is None:
+            try:
+                instr = self.parse(unparsed.line, unparsed.lineno)
+                if isinstance(instr, Instruction):
+                    instr.args = self.compile_args(instr.name, instr.text)
+                    errors = self.verify(instr)
+                    if errors:
+                        raise ParseException(errors[0])
+            except ParseException as e:
+                sys.stderr.write('%s: ERROR: %s\n' % (unparsed.lineno, unparsed.line))
+                sys.stderr.write('%s: ERROR: %s\n' % (unparsed.lineno, e))
+                raise e
+            unparsed.decoded = instr
+        self.memory[pc] = unparsed.decoded
+        return unparsed.decoded
+
+    def snapshot(self):
+        '''
+        A CpuState of memory, registers, stack, program counter and flags.
+        Memory cells are copied by reference, so Setable values are shared
+        with the snapshot.
+
+        >>> cpu = Cpu('snapshot test', engine=FAST)
+        >>> cpu.load(['copy R0 0', 'loop:', 'compute R0 + R0 1', 'push R0', 'test R0 < 5', 'jumpif loop', 'halt'])
+        >>> cpu.run_cycles(6)
+        6
+        >>> state = cpu.snapshot()
+        >>> cpu.run()
+        >>> cpu.registers[0], cpu.stack, cpu.halted_flag
+        (5, [1, 2, 3, 4, 5], True)
+        >>> cpu.restore(state)
+        >>> cpu.registers[0], cpu.stack, cpu.halted_flag, cpu.program_counter
+        (2, [1], False, 2)
+        >>> cpu.run()
+        >>> cpu.registers[0], cpu.stack
+        (5, [1, 2, 3, 4, 5])
+        '''
+        return CpuState(self)
+
+    def restore(self, state):
+        '''Puts back the state from snapshot. Lists are updated in place so
+        fast engine closures are only dropped for memory that changed.'''
+        sparse = isinstance(self.memory, SparseList)
+        if self.code is not None:
+            if sparse:
+                changed = [addr for addr in set(self.memory.keys() + state.memory.keys())
+                           if self.memory.get(addr) is not state.memory.get(addr)]
+            else:
+                changed = compress(xrange(len(self.memory)), map(operator.is_not, self.memory, state.memory))
+            for addr in changed:
+                for start in xrange(max(0, addr - FUSE_MAX + 1), addr + 1):
+                    self.code[start] = None
+        if sparse:
+            for cells, saved in (self.memory, state.memory), (self.readonly, state.readonly):
+                cells.clear()
+                cells.update(saved)
+        else:
+            self.memory[:] = state.memory
+            self.readonly[:] = state.readonly
+        self.registers[:] = state.registers
+        self.stack[:] = state.stack
+        self.program_counter = state.program_counter
+        self.test_flag = state.test_flag
+        self.trace_flag = state.trace_flag
+        self.halted_flag = state.halted_flag
+        self.stall = state.stall
 
     def run(self):
         try:
             while not self.halted_flag:
-                self.cpu_cycle()
+                self.run_cycles(MEMSIZE)
         except RuntimeException as e:
             sys.stderr.write('System halted: ' + str(e))
             raise e
 
+    def run_cycles(self, cycles):
+        '''
+        Runs up to cycles instructions and returns how many were run. Returns
+        early when the Cpu halts or when the program counter reaches one of
+        the addresses in breakpoints. The instruction at the breakpoint runs
+        first thing on the next call.
+
+        >>> cpu = Cpu('run_cycles test')
+        >>> cpu.load(['copy R0 0', 'loop:', 'compute R0 + R0 1', 'test R0 < 5', 'jumpif loop', 'halt'])
+        >>> cpu.breakpoints.add(3)
+        >>> cpu.run_cycles(100), cpu.program_counter, cpu.registers[0]
+        (3, 3, 1)
+        >>> cpu.breakpoints.clear()
+        >>> cpu.run_cycles(100), cpu.halted_flag, cpu.registers[0]
+        (14, True, 5)
+        >>> cpu.run_cycles(100)
+        0
+        '''
+        breakpoints = self.breakpoints
+        done = 0
+        while done < cycles and not self.halted_flag:
+            if self.stall:
+                paid = min(self.stall, cycles - done)
+                self.stall -= paid
+                done += paid
+                continue
+            if self.profile is not None:
+                done += self.profile_cycles(cycles - done, breakpoints)
+            elif self.engine is FAST and not self.trace_flag:
+                done += self.fast_cycles(cycles - done, breakpoints)
+            else:
+                done += self.reference_cycles(cycles - done, breakpoints)
+            if breakpoints and self.program_counter in breakpoints:
+                break
+        return done
+
+    def reference_cycles(self, cycles, breakpoints=None):
+        '''
+        Runs up to cycles instructions on the reference interpreter and
+        returns how many were run. Stops early when the Cpu halts, a
+        breakpoint is reached or, on the fast engine, trace is turned off.
+        '''
+        memory = self.memory
+        done = 0
+        while done < cycles:
+            pc = self.program_counter
+            instr = memory[pc]
+            if self.trace_flag:
+                self.trace_instruction(pc, instr)
+            done += 1
+            if instr is END_OF_PROGRAM:
+                self.halted_flag = True
+                break
+            try:
+                func, args = instr.func, instr.args
+            except AttributeError:
+                raise RuntimeException('No instruction at ' + str(pc))
+            if not func(self, *args):
+                self.program_counter += 1
+            if breakpoints and self.program_counter in breakpoints:
+                break
+            if self.stall or self.engine is FAST and not self.trace_flag:
+                break
+        return done
+
+    def profile_cycles(self, cycles, breakpoints=None):
+        '''reference_cycles counting every instruction in profile.'''
+        memory = self.memory
+        profile = self.profile
+        done = 0
+        while done < cycles:
+            pc = self.program_counter
+            instr = memory[pc]
+            if self.trace_flag:
+                self.trace_instruction(pc, instr)
+            done += 1
+            if isinstance(instr, Unparsed):
+                instr = self.decode(pc)
+            profile.record(pc, instr)
+            if instr is END_OF_PROGRAM:
+                self.halted_flag = True
+                break
+            try:
+                func, args = instr.func, instr.args
+            except AttributeError:
+                raise RuntimeException('No instruction at ' + str(pc))
+            if not func(self, *args):
+                self.program_counter += 1
+            elif instr.name == 'call' or instr.name == 'callif':
+                profile.call(pc, self.program_counter)
+            if instr.name == 'back' or isinstance(instr, Syscall):
+                profile.back()
+            if len(self.stack) > profile.stack_max:
+                profile.stack_max = len(self.stack)
+            if breakpoints and self.program_counter in breakpoints:
+                break
+            if self.stall:
+                break
+        return done
+
+    def trace_instruction(self, pc, instr):
+        '''Traces instr at pc to tracer, or as disassembly to out without one.'''
+        if isinstance(instr, Unparsed):
+            instr = self.decode(pc)
+        if self.tracer is not None:
+            self.tracer.record(self, pc, instr)
+        else:
+            for line in self.disassemble([instr], pc).split('\n'):
+                self.out.write('> ' + line + '\n')
+
     def cpu_cycle(self):
         if self.halted_flag:
             return
-        instr = self.memory[self.program_counter]
-        if self.trace_flag:
-            for line in self.disassemble([instr], self.program_counter).split('\n'):
-                self.out.write('> ' + line + '\n')
-        if instr is END_OF_PROGRAM:
-            self.halted_flag = True
+        if self.stall:
+            self.stall -= 1
             return
-        method, args = instr
-        if not method(*args):
-            self.program_counter += 1
+        if self.profile is not None:
+            self.profile_cycles(1)
+        elif self.engine is FAST and not self.trace_flag:
+            self.fast_cycles(1)
+        else:
+            self.reference_cycles(1)
+
+    def fast_cycles(self, cycles, breakpoints=None):
+        '''
+        Runs up to cycles instructions on the fast engine and returns how many
+        were run. Stops early when the Cpu halts, a breakpoint is reached or
+        trace is turned on, as tracing is left to the reference interpreter.
+        '''
+        if self.fusion and not breakpoints:
+            return self.fused_cycles(cycles)
+        code = self.fast_code()
+        translate = self.translate
+        # Fused closures count cost cycles, see fused_cycles
+        cost = self.cost if self.fusion else None
+        def single():
+            self.reference_cycles(1)
+        pc = self.program_counter
+        done = 0
+        try:
+            while done < cycles:
+                step = code[pc] or translate(pc)
+                count = cost[pc] if cost is not None else 1
+                if count > 1 and (done + count > cycles
+                                  or any([addr in breakpoints for addr in xrange(pc + 1, pc + count)])):
+                    # The group passes a breakpoint or the end of the budget,
+                    # its first instruction runs on its own
+                    self.program_counter = pc
+                    step, count = single, 1
+                start = pc
+                pc = step()
+                if step is not single and cost is not None:
+                    # A self modifying group may stop early, see FastTranslator.write
+                    count = cost[start]
+                done += count
+                if pc is None:
+                    pc = self.program_counter
+                    if self.stall and self.stall <= cycles - done:
+                        # System call cycles that fit are paid here, not in run_cycles
+                        done += self.stall
+                        self.stall = 0
+                    if self.halted_flag or self.trace_flag or self.stall:
+                        break
+                if breakpoints and pc in breakpoints:
+                    break
+        finally:
+            self.program_counter = pc
+        return done
+
+    def fused_cycles(self, cycles):
+        '''fast_cycles for programs with fused instructions, each closure
+        counts cost cycles.'''
+        code = self.fast_code()
+        cost = self.cost
+        translate = self.translate
+        pc = self.program_counter
+        done = 0
+        try:
+            while done < cycles:
+                # Far from the end of the budget any closure fits
+                limit = cycles - FUSE_MAX
+                while done <= limit:
+                    start = pc
+                    pc = (code[pc] or translate(pc))()
+                    done += cost[start]
+                    if pc is None:
+                        break
+                if pc is None:
+                    pc = self.program_counter
+                    if self.stall and self.stall <= cycles - done:
+                        done += self.stall
+                        self.stall = 0
+                    if self.halted_flag or self.trace_flag or self.stall:
+                        break
+                    continue
+                if done >= cycles:
+                    break
+                step = code[pc] or translate(pc)
+                if done + cost[pc] > cycles:
+                    self.program_counter = pc
+                    done += self.reference_cycles(1)
+                    pc = self.program_counter
+                    continue
+                start = pc
+                pc = step()
+                done += cost[start]
+                if pc is None:
+                    pc = self.program_counter
+                    if self.stall and self.stall <= cycles - done:
+                        done += self.stall
+                        self.stall = 0
+                    if self.halted_flag or self.trace_flag or self.stall:
+                        break
+        finally:
+            self.program_counter = pc
+        return done
+
+    def fast_code(self):
+        '''The fast engine closures by address. The closures are bound to the
+        current memory, registers, stack and read only map so they are
+        dropped if any of those is replaced.'''
+        if (self.code is None or self.code_bound[0] is not self.memory
+                or self.code_bound[1] is not self.registers or self.code_bound[2] is not self.stack
+                or self.code_bound[3] is not self.readonly):
+            self.code = SparseList(self.memsize) if self.sparse else [None] * self.memsize
+            self.code_bound = self.memory, self.registers, self.stack, self.readonly
+        return self.code
+
+    def translate(self, pc):
+        '''Translates the instruction at pc into a fast engine closure.'''
+        instr = self.memory[pc]
+        if isinstance(instr, Unparsed):
+            instr = self.decode(pc)
+        if instr is END_OF_PROGRAM:
+            def step():
+                self.halted_flag = True
+                self.program_counter = pc
+        elif isinstance(instr, Syscall):
+            handler, stall, stack = instr.handler, instr.cost - 1, self.stack
+            def step():
+                # run_syscall
+                self.program_counter = pc
+                self.stall += stall
+                handler(self)
+                self.program_counter = int(stack.pop()) + 1
+        elif not isinstance(instr, Instruction):
+            raise RuntimeException('No instruction at ' + str(pc))
+        elif instr.name in FAST_INSTRUCTIONS:
+            instrs = [instr]
+            fusion = self.fusion.get(pc)
+            if fusion:
+                group = self.memory[pc:pc + len(fusion)]
+                if all([isinstance(i, Instruction) for i in group]) and tuple([i.name for i in group]) == fusion:
+                    instrs = group
+                self.cost[pc] = len(instrs)
+            step = FastTranslator(instrs, pc, self.fusion, self.memsize).make(self, self.code)
+        else:
+            func, args = instr.func, instr.args
+            def step():
+                self.program_counter = pc
+                if not func(self, *args):
+                    self.program_counter = pc + 1
+        self.code[pc] = step
+        return step
 
     def get_address(self, address):
+        '''
+        The address a number, label or register refers to, with or without @.
+
+        >>> cpu = Cpu('address test')
+        >>> cpu.load(['copy R1 data', 'halt', 'data:', '=0'])
+        >>> cpu.get_address('data'), cpu.get_address('@12'), cpu.get_address(12)
+        (2, 12, 12)
+        >>> cpu.run()
+        >>> cpu.get_address('@R1')
+        2
+        >>> cpu.get_address(256)
+        Traceback (most recent call last):
+        RuntimeException: Address 256 out of bounds (256)
+        >>> cpu.get_address('R0')
+        Traceback (most recent call last):
+        RuntimeException: Address R0 out of bounds (None)
+        '''
+        address = str(address)
+        if address[:1] == '@':
+            address = address[1:]
         try:
-            addr = int(address)
-        except:
-            addr = None
-            if address[1] == 'R':
-                try:
-                    addr = self.registers[int(address[2:])]
-                except:
-                    pass
-            if addr is None:
-                addr = self.labels.get(address)
-            if addr is None:
-                self.out.write(repr(self.labels) + '\n')
-                raise RuntimeException('Invalid address reference ' + address)
-        if addr > MEMSIZE or addr < 0:
-            raise RuntimeException('Address ' + address + ' out of bounds (' + addr + ')')
-        return addr
+            return self.compile_address(address).address(self)
+        except ParseException as e:
+            raise RuntimeException(str(e))
 
-    def set_value(self, target, value):
-        if target[0] == '@':
-            addr = self.get_address(target[1:])
-            if isinstance(self.memory[addr], Setable):
-                self.memory[addr].set(value)
-            elif isinstance(self.memory[addr], Getable):
-                raise RuntimeException('Target is read only ' + target)
-            else:
-                self.memory[addr] = value
-        elif target[0] == 'R':
-            self.registers[int(target[1:])] = value
+    def read(self, addr):
+        res = self.memory[addr]
+        if isinstance(res, Getable):
+            return res.get()
+        return res
+
+    def protect(self, addr, count=1):
+        '''
+        Makes count cells from addr read only for programs, the host still
+        sets them directly in memory.
+
+        >>> cpu = Cpu('protect test')
+        >>> cpu.load(['copy @data 1', 'halt', 'data:', '=0'])
+        >>> cpu.protect(cpu.labels['data'])
+        >>> cpu.memory[cpu.labels['data']] = 42
+        >>> cpu.get_value('@data')
+        42
+        >>> cpu.run_cycles(1)
+        Traceback (most recent call last):
+        RuntimeException: Target is read only @2
+        '''
+        self.readonly[addr:addr + count] = [1] * count
+
+    def write(self, addr, value):
+        if self.readonly[addr]:
+            raise RuntimeException('Target is read only @' + str(addr))
+        if isinstance(self.memory[addr], Setable):
+            self.memory[addr].set(value)
+        elif isinstance(self.memory[addr], Getable):
+            raise RuntimeException('Target is read only @' + str(addr))
         else:
-            raise RuntimeException('Invalid target reference ' + target)
+            self.memory[addr] = value
+
+    def set_value(self, target, value):
+        if not isinstance(target, Operand):
+            target = self.compile_operand(target, TARGET)
+        target.set(self, value)
 
     def get_value(self, value):
-        if not value:
-            return None
-        if value[0] == '@':
-            res = self.memory[self.get_address(value[1:])]
-            if isinstance(res, Getable):
-                return res.get()
-            return res
-        if value[0] == 'R':
-            return self.registers[int(value[1:])]
-        if len(value) >= 2 and value[0] == "'" and value[-1] == "'":
-            return value[1:-1]
-        try:
-            return int(value)
-        except:
-            try:
-                return float(value)
-            except:
-                if value in self.labels:
-                    return self.labels[value]
-        raise RuntimeException('Invalid value reference ' + value)
+        if not isinstance(value, Operand):
+            value = self.compile_operand(value)
+        return value.get(self)
 
     def copy(self, target, value):
-        self.set_value(target, self.get_value(value))
+        target.set(self, value.get(self))
 
     def test(self, left, op, right):
-        left = self.get_value(left)
-        right = self.get_value(right)
-        if op == '<':
-            self.test_flag = left < right
-        elif op == '>':
-            self.test_flag = left > right
-        elif op == '<=':
-            self.test_flag = left <= right
-        elif op == '>=':
-            self.test_flag = left >= right
-        elif op == '!=':
-            self.test_flag = left != right
-        elif op == '=':
-            self.test_flag = left = right
+        self.test_flag = op(left.get(self), right.get(self))
 
     def compute(self, target, func, *values):
-        values = [self.get_value(value) for value in values]
-        res = values[0]
-        del values[0]
-        if func == '+':
-            res += sum(values)
-        elif func == '-':
-            res -= sum(values)
-        elif func == '*':
-            for val in values:
-                res *= val
-        elif func == '/':
-            for val in values:
-                res /= val
-        else:
-            raise RuntimeException('Unsupported func ' + func)
-        self.set_value(target, res)
+        values = [value.get(self) for value in values]
+        target.set(self, func(values[0], values[1:]))
 
     def pop(self, target):
-        self.set_value(target, self.stack.pop())
+        target.set(self, self.stack.pop())
 
     def push(self, value):
-        self.stack.append(self.get_value(value))
+        self.stack.append(value.get(self))
 
     def jump(self, label):
-        self.program_counter = self.labels[label]
+        '''
+        Branches to label, a fixed address or a register holding one.
+
+        >>> for engine in ENGINES:
+        ...     cpu = Cpu('jump test', engine=engine)
+        ...     cpu.load(['copy R0 target', 'jump R0', 'halt', 'target:', 'copy R0 2.0', 'call R0'])
+        ...     cpu.run()
+        ...     print cpu.program_counter, cpu.stack
+        2 [4]
+        2 [4]
+        >>> cpu.load(['@10', 'copy R0 -1', 'jump R0'])
+        >>> cpu.program_counter, cpu.halted_flag = 10, False
+        >>> cpu.run()
+        Traceback (most recent call last):
+        RuntimeException: Address R0 out of bounds (-1)
+        '''
+        self.program_counter = label.target(self)
         return True
 
     def jumpif(self, label):
@@ -405,7 +1855,7 @@ class Cpu(object):
 
     def call(self, label):
         self.stack.append(self.program_counter)
-        self.program_counter = self.get_address(label)
+        self.program_counter = label.target(self)
         return True
 
     def callif(self, label):
@@ -415,6 +1865,49 @@ class Cpu(object):
     def back(self):
         self.program_counter = int(self.stack.pop())
 
+    def run_unparsed(self):
+        '''Decodes the Unparsed line at the program counter and runs it.'''
+        instr = self.decode(self.program_counter)
+        if instr is END_OF_PROGRAM:
+            self.halted_flag = True
+            return True
+        return instr.func(self, *instr.args)
+
+    def syscall(self, name, handler, cost=SYSCALL_COST):
+        '''
+        Installs handler as the system call at label name, which must be a
+        halt in the loaded program. Calling the label runs handler(cpu) and
+        returns to the caller, counting cost cycles. Cycles beyond those left
+        in run_cycles are taken from the next run.
+
+        >>> def triple(cpu):
+        ...     cpu.registers[0] *= 3
+        >>> for engine in ENGINES:
+        ...     cpu = Cpu('syscall test', engine=engine)
+        ...     cpu.load(['copy R0 2', 'call _triple', 'compute R0 + R0 1', 'halt', '_triple:', 'halt'])
+        ...     cpu.syscall('_triple', triple, 4)
+        ...     print cpu.run_cycles(4), cpu.registers[0], cpu.run_cycles(4), cpu.registers[0], cpu.halted_flag
+        4 6 4 7 True
+        4 6 4 7 True
+        '''
+        if name not in self.labels:
+            raise ValueError('No label ' + name)
+        addr = self.labels[name]
+        if self.memory[addr] is not END_OF_PROGRAM and not isinstance(self.memory[addr], Syscall):
+            raise ValueError('No halt at ' + name)
+        self.memory[addr] = Syscall(name, handler, cost)
+        self.protect(addr)
+        if self.code is not None:
+            self.code[addr] = None
+
+    def run_syscall(self, syscall):
+        '''Runs a system call and returns past the call instruction, whose
+        address is on the stack.'''
+        self.stall += syscall.cost - 1
+        syscall.handler(self)
+        self.program_counter = int(self.stack.pop()) + 1
+        return True
+
     def trace(self):
         self.trace_flag = True
 
@@ -434,9 +1927,9 @@ class Cpu(object):
         debug = []
         for value in values:
             try:
-                debug.append(str(self.get_value(value)))
+                debug.append(str(value.get(self)))
             except:
-                debug.append('**' + str(value))
+                debug.append('**' + value.text)
         self.out.write("DEBUG: " + ', '.join(debug) + "\n")
 
     def longdebug(self, *values):
@@ -449,13 +1942,23 @@ class Cpu(object):
         self.out.write('Memory disassembled\n')
         self.out.write(self.disassemble(self.memory) + '\n')
 
-    def disassemble(self, mem, start_address=0):
+    def disassemble(self, mem, start_address=0, counts=None):
+        '''
+        Assembler source for mem loaded at start_address. With counts, a dict
+        of numbers by address, each instruction line starts with its number.
+        '''
         res = []
-        def output(data):
+        def line(data, count=''):
+            if counts is not None:
+                data = '%9s ' % count + data
+            res.append(data)
+        def output(data, count=''):
             if skipped_last:
-                res.append('@' + str(addr))
-            res.append(str(data))
+                line('@' + str(addr))
+            line(str(data), count)
         skipped_last = len(mem) > 1
+        if isinstance(mem, SparseList):
+            mem = mem.dense()
         addr = start_address - 1
         rev_labels = {a:label for label, a in self.labels.iteritems()}
         for instr in mem:
@@ -466,12 +1969,15 @@ class Cpu(object):
             if instr is None:
                 skipped_last = True
             else:
+                count = counts.get(addr, 0) if counts is not None else ''
                 if instr is END_OF_PROGRAM:
-                    output('halt')
-                elif isinstance(instr, tuple) and isinstance(instr[0], type(self.disassemble)):
-                    method, args = instr
-                    name = method.__name__
-                    output('    ' + name + ' ' + ' '.join(args))
+                    output('halt', count)
+                elif isinstance(instr, Instruction):
+                    output('    ' + ' '.join([instr.name] + instr.text), count)
+                elif isinstance(instr, Unparsed):
+                    output('    ' + instr.line, count)
+                elif isinstance(instr, Syscall):
+                    output('halt  # ' + SYSCALL + ' ' + instr.name, count)
                 else:
                     output('=' + repr(instr))
                 skipped_last = False
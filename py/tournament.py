@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+'''
+Plays crashbots matches between the robot programs in a directory over a
+pool of processes and ranks the programs.
+
+Usage: tournament.py <bot directory> [options], see --help
+'''
+
+import os
+import sys
+import json
+import argparse
+import itertools
+import multiprocessing
+import simcpu
+import crashbots
+from replay import ReplayWriter
+from metrics import Metrics
+
+## Default arena and match settings
+WIDTH = 20
+HEIGHT = 20
+TICKS = 1000
+
+def load_bots(directory):
+    '''Reads every file in directory as a robot program, keyed by file name
+    without extension. Files ending in .gz are decompressed.'''
+    res = {}
+    for filename in sorted(os.listdir(directory)):
+        path = os.path.join(directory, filename)
+        if os.path.isfile(path):
+            name = filename[:-3] if filename.endswith('.gz') else filename
+            with simcpu.open_source(path) as f:
+                res[os.path.splitext(name)[0]] = f.read().split('\n')
+    return res
+
+def round_robin(names, rounds=1):
+    '''
+    Every pair of names plays rounds matches.
+
+    >>> list(round_robin(['a', 'b', 'c'], 2))
+    [('a', 'b'), ('a', 'c'), ('b', 'c'), ('a', 'b'), ('a', 'c'), ('b', 'c')]
+    '''
+    for _ in xrange(rounds):
+        for pair in itertools.combinations(names, 2):
+            yield pair
+
+def read_schedule(lines):
+    '''
+    A schedule has one match per line, the bot names separated by spaces.
+
+    >>> list(read_schedule(['# Finals', 'a b', '', 'a b c']))
+    [('a', 'b'), ('a', 'b', 'c')]
+    '''
+    for line in lines:
+        line = line.strip()
+        if line and line[0] != '#':
+            yield tuple(line.split())
+
+def play(match, progress=None):
+    '''
+    Plays one match, match is (number, seed, bots, settings) where bots is a
+    list of (name, program) and settings holds width, height and ticks, and
+    optionally the memsize, registers and sparse of the robot Cpus.
+    Robot start squares only depend on seed. progress is called with the
+    arena after every tick. If settings has a trace
+    directory every instruction is traced to <match number>.trace there,
+    robot ids are the trace ids. If it has a replay directory the match is
+    recorded to <match number>.replay there. If it has metrics set the
+    result has the Metrics of the match.
+
+    >>> bots = [('runner', ['copy @_desired_speed 10', 'halt']), ('sitter', ['halt'])]
+    >>> result = play((1, 1, bots, {'width': 5, 'height': 5, 'ticks': 50}))
+    >>> result['winner'], result['ticks'], result['health']
+    ('sitter', 10, [0, 100])
+    '''
+    number, seed, bots, settings = match
+    trace = replay = None
+    try:
+        if settings.get('trace'):
+            trace = open(os.path.join(settings['trace'], '%d.trace' % number), 'wb')
+        if settings.get('replay'):
+            replay = open(os.path.join(settings['replay'], '%d.replay' % number), 'wb')
+        arena = crashbots.Arena(settings['width'], settings['height'], headless=True,
+                                tracer=trace and simcpu.TraceBuffer(trace),
+                                metrics=Metrics() if settings.get('metrics') else None,
+                                memsize=settings.get('memsize') or simcpu.MEMSIZE,
+                                registers=settings.get('registers') or simcpu.REGISTERS,
+                                sparse=settings.get('sparse', False))
+        for (x, y), (name, program) in zip(arena.free_squares(len(bots), seed), bots):
+            arena.add_robot(name, x, y, program).cpu.trace_flag = trace is not None
+        if replay:
+            writer = ReplayWriter(replay, arena)
+            while not arena.done(settings['ticks']):
+                arena.run_tick()
+                writer.write()
+        result = arena.run(settings['ticks'], progress)
+    finally:
+        for f in trace, replay:
+            if f:
+                f.close()
+    res = {'match': number, 'seed': seed, 'bots': [name for name, _ in bots],
+           'winner': result.winner, 'ticks': result.ticks,
+           'health': [health for _, _, health in result.health]}
+    if arena.metrics is not None:
+        res['metrics'] = arena.metrics
+    return res
+
+class Leaderboard(object):
+    '''
+    Wins, draws and losses per bot. A match without a winner is a draw for
+    everyone in it.
+
+    >>> board = Leaderboard()
+    >>> board.add({'bots': ['a', 'b'], 'winner': 'a'})
+    >>> board.add({'bots': ['a', 'b'], 'winner': None})
+    >>> print board
+    bot  wins draws losses
+    a       1     1      0
+    b       0     1      1
+    '''
+    def __init__(self):
+        self.scores = {}
+
+    def add(self, result):
+        for name in result['bots']:
+            score = self.scores.setdefault(name, [0, 0, 0])
+            if result['winner'] is None:
+                score[1] += 1
+            elif result['winner'] == name:
+                score[0] += 1
+            else:
+                score[2] += 1
+
+    def ranking(self):
+        return sorted(self.scores.iteritems(), key=lambda (name, score): (-score[0], -score[1], name))
+
+    def __str__(self):
+        width = max([3] + [len(name) for name in self.scores])
+        lines = ['%-*s  wins draws losses' % (width, 'bot')]
+        for name, (wins, draws, losses) in self.ranking():
+            lines.append('%-*s %5d %5d %6d' % (width, name, wins, draws, losses))
+        return '\n'.join(lines)
+
+def run_tournament(bots, schedule, results, seed=0, processes=None, metrics=None, **settings):
+    '''
+    Plays the schedule, a sequence of tuples of bot names, over a process pool.
+    Every result is written to the results file as a JSON line as soon as it
+    is done. Match number n is played with seed + n. The metrics of every
+    match are merged into metrics if it is a Metrics. Returns the Leaderboard.
+    '''
+    settings['metrics'] = metrics is not None
+    matches = [(number, seed + number, [(name, bots[name]) for name in names], settings)
+               for number, names in enumerate(schedule)]
+    board = Leaderboard()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(play, matches):
+            if 'metrics' in result:
+                metrics.merge(result.pop('metrics'))
+            results.write(json.dumps(result, sort_keys=True) + '\n')
+            results.flush()
+            board.add(result)
+    finally:
+        pool.terminate()
+    return board
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Plays crashbots matches and ranks the bots.')
+    parser.add_argument('directory', help='directory of robot programs')
+    parser.add_argument('--schedule', help='file with one match per line, bot names separated by spaces '
+                        '(default: round robin)')
+    parser.add_argument('--rounds', type=int, default=1, help='round robin rounds (default: %(default)s)')
+    parser.add_argument('--results', default='results.jsonl', help='JSON lines output (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first match (default: %(default)s)')
+    parser.add_argument('--processes', type=int, help='worker processes (default: one per core)')
+    parser.add_argument('--width', type=int, default=WIDTH)
+    parser.add_argument('--height', type=int, default=HEIGHT)
+    parser.add_argument('--ticks', type=int, default=TICKS)
+    parser.add_argument('--memsize', type=int, default=simcpu.MEMSIZE, help='robot memory words (default: %(default)s)')
+    parser.add_argument('--registers', type=int, default=simcpu.REGISTERS,
+                        help='robot registers (default: %(default)s)')
+    parser.add_argument('--sparse', action='store_true',
+                        help='keep only the memory cells each robot sets, for large memories')
+    parser.add_argument('--trace', metavar='DIRECTORY', help='trace every match to DIRECTORY, see traceview.py')
+    parser.add_argument('--replay', metavar='DIRECTORY', help='record every match to DIRECTORY, see replay.py')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write tick stage timings and cycle use to FILE, Prometheus text if it ends in .prom, '
+                        'JSON otherwise')
+    args = parser.parse_args(argv)
+    bots = load_bots(args.directory)
+    if args.schedule:
+        with open(args.schedule) as f:
+            schedule = list(read_schedule(f))
+    else:
+        schedule = list(round_robin(sorted(bots), args.rounds))
+    metrics = Metrics() if args.metrics else None
+    with open(args.results, 'w') as results:
+        board = run_tournament(bots, schedule, results, args.seed, args.processes, metrics,
+                               width=args.width, height=args.height, ticks=args.ticks, trace=args.trace,
+                               replay=args.replay, memsize=args.memsize, registers=args.registers,
+                               sparse=args.sparse)
+    if metrics is not None:
+        with open(args.metrics, 'w') as f:
+            if args.metrics.endswith('.prom'):
+                f.write(metrics.prometheus())
+            else:
+                f.write(json.dumps(metrics.json(), indent=1, sort_keys=True) + '\n')
+    print board
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+'''
+Reads the binary trace records written by simcpu.TraceBuffer, filters them
+and disassembles the traced instructions as they are printed.
+
+Usage: traceview.py <trace file> [options], see --help
+'''
+
+import sys
+import argparse
+import simcpu
+import crashbots
+from itertools import chain
+
+## Records read at a time
+CHUNK = 4096
+
+def read_records(f):
+    '''Yields the records in the binary file f as tuples, see simcpu.TRACE_RECORD.'''
+    size = simcpu.TRACE_RECORD.size
+    while True:
+        data = f.read(size * CHUNK)
+        for offset in xrange(0, len(data) - size + 1, size):
+            yield simcpu.TRACE_RECORD.unpack_from(data, offset)
+        if len(data) < size * CHUNK:
+            break
+
+def select(records, first=None, last=None, ids=None, pcs=None, opcodes=None):
+    '''
+    The records from tick first to tick last with a trace id in ids, a
+    program counter in pcs and an instruction named in opcodes. None
+    matches everything.
+    '''
+    numbers = opcodes and set([simcpu.OPCODES.index(name) for name in opcodes])
+    for record in records:
+        tick, ident, pc, opcode = record[:4]
+        if ((first is None or tick >= first) and (last is None or tick <= last)
+                and (not ids or ident in ids) and (not pcs or pc in pcs)
+                and (not numbers or opcode in numbers)):
+            yield record
+
+def describe(record, cpus):
+    '''
+    One line for a record. The instruction is disassembled from the Cpu in
+    cpus by trace id, or only named if there is none.
+
+    >>> from StringIO import StringIO
+    >>> cpu = simcpu.Cpu('viewed')
+    >>> cpu.load(['copy R0 1', 'loop:', 'compute R0 + R0 1', 'test R0 < 3', 'jumpif loop', 'halt'])
+    >>> out = StringIO()
+    >>> cpu.tracer, cpu.trace_flag = simcpu.TraceBuffer(out), True
+    >>> cpu.run()
+    >>> out.seek(0)
+    >>> for record in select(read_records(out), pcs=[1, 4]):
+    ...     print describe(record, {0: cpu})
+         0   0    1   loop: compute R0 + R0 1       1 - - -
+         0   0    1   loop: compute R0 + R0 1     T 2 - - -
+         0   0    4   halt                          3 - - -
+    >>> out.seek(0)
+    >>> print describe(list(read_records(out))[-1], {})
+         0   0    4   halt                          3 - - -
+    '''
+    tick, ident, pc, opcode, test = record[:5]
+    cpu = cpus.get(ident)
+    if cpu is not None:
+        text = ' '.join([line.strip() for line in cpu.disassemble([cpu.memory[pc]], pc).split('\n')])
+    else:
+        text = simcpu.OPCODES[opcode]
+    registers = ['-' if value != value else '%g' % value for value in record[5:]]
+    return '%6d %3d %4d   %-27s %s %s' % (tick, ident, pc, text, 'T' if test else ' ', ' '.join(registers))
+
+def load_cpu(filename, bot):
+    '''A Cpu with the program in filename loaded, after the robot base
+    program if bot is set so addresses match crashbots robots.'''
+    cpu = simcpu.Cpu(filename)
+    with simcpu.open_source(filename) as f:
+        cpu.load(chain(crashbots.Robot.base_program, f) if bot else f)
+    return cpu
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Prints simcpu trace records.')
+    parser.add_argument('trace', help='trace file')
+    parser.add_argument('--bot', action='append', default=[], metavar='ID=FILE',
+                        help='disassemble trace id ID with the crashbots robot program in FILE')
+    parser.add_argument('--program', action='append', default=[], metavar='ID=FILE',
+                        help='disassemble trace id ID with the plain program in FILE')
+    parser.add_argument('--first', type=int, help='first tick')
+    parser.add_argument('--last', type=int, help='last tick')
+    parser.add_argument('--id', type=int, action='append', help='only this trace id, repeatable')
+    parser.add_argument('--pc', type=int, action='append', help='only this address, repeatable')
+    parser.add_argument('--opcode', action='append', choices=simcpu.OPCODES, help='only this instruction, repeatable')
+    args = parser.parse_args(argv)
+    cpus = {}
+    for option, bot in [(args.bot, True), (args.program, False)]:
+        for value in option:
+            ident, filename = value.split('=', 1)
+            cpus[int(ident)] = load_cpu(filename, bot)
+    with open(args.trace, 'rb') as f:
+        for record in select(read_records(f), args.first, args.last, args.id, args.pc, args.opcode):
+            print describe(record, cpus)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])